@@ -32,42 +32,16 @@ except ImportError:
 	print "Unable to import lxml, install with easy_install lxml"
 	sys.exit(0)
 
-# Read all the XML files into our own list of dictionaries
-def readXMLs(files):
+# Read all the XML files in the catalog into our own list of dictionaries, the
+# information is read from the compiled configuration files. Packages are
+# sorted by name and the variants are in the order they are tried.
+def readXMLs(catalog):
 	ret = []
-	for File in files:
-		ins = {"name" : File}
-		ins2 = {}
-		f = open(File, "r")
-		tree = ET.parse(f)
-		root = tree.getroot()
-		info = root.find("information")
-		if info == None:
-			ins["info"] = None
-		else:
-			for c in info.iterchildren("*"):
-				if c.tag == "description":
-					ins2["description"] = c.text.replace("\n", " ").strip()
-				elif c.tag == "tested":
-					devices = []
-					for d in c.iterchildren("device"):
-						devices.append({"os" : d.get("os"), "device" : d.get("device")})
-					ins2["tested"] = devices
-				elif c.tag == "short":
-					ins2["short"] = c.text
-				elif c.tag == "extra":
-					tables = []
-					for t in c.iterchildren("table"):
-						tableE = {"id" : t.get("id"), "columns" : t.get("columns"),\
-						"reason" : t.get("reason")}
-						if tableE["columns"] != None:
-							tableE["columns"] = tableE["columns"].split(";")
-						else:
-							tableE["columns"] = []
-						tables.append(tableE)
-					ins2["extra"] = tables
-			ins["info"] = ins2
-		ret.append(ins)
+	for package in sorted(catalog.keys()):
+		for File in catalog[package]:
+			ins = {"name" : os.path.basename(File)}
+			ins["info"] = xmlConfig.getConfig(File)["info"]
+			ret.append(ins)
 	return ret
 
 # Print information about one program
@@ -172,13 +146,13 @@ if __name__== '__main__':
 	
 	# Include common functions
 	sys.path.insert(0, '../src/droidlog')
-	import droidlog
+	import xmlConfig
 
-	# Get a list of all configuration files
-	Files = droidlog.getAllFilesReg(scriptPath)
+	# Get all configuration files, grouped by package
+	catalog = xmlConfig.getCatalog(scriptPath)
 
 	# Read in all the information
-	infoList = readXMLs(Files)
+	infoList = readXMLs(catalog)
 
 	# Check if we should inverse any of the filters
 	for key in notInverse.keys():
@@ -33,12 +33,35 @@ from datetime import datetime
 import math
 import shutil	# To copy files
 import hashlib, json
+import calendar
+import copy
+import collections
+import multiprocessing
+import multiprocessing.pool
+import tempfile
+import atexit
+import heapq
+import struct, mmap
+import gzip, io, subprocess
+import threading
+import Queue
+import cPickle as pickle
 
 try:
 	from lxml import etree as ET
 except ImportError:
 	print "Unable to import lxml, install with easy_install lxml"
 	sys.exit(0)
+# Only needed for LogCat files compressed with xz, the xz program is used if
+# the module is not available
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
 try:
 	import downloadLibraries
 except ImportError:
@@ -61,8 +84,6 @@ try:
 	sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
 	'src/shapefile'))
 	import reverseGEO
-	Base = os.path.join(os.path.join("src", "shapefile"), "sources")
-	reversegeo = reverseGEO.geoFiles(Base, "countries.geojson")
 except ImportError:
 	print "Unable to import reverseGEO, will not print locations"
 
@@ -82,9 +103,120 @@ globalStatus = "Unknown"
 # Root output directory
 output = ""
 
+# Directory in the output directory for temporary files, it is removed when we
+# exit, also when we exit early
+tempDir = None
+
+# Settings in a worker process, they are given once when the worker starts
+# instead of with every package
+workerSettings = None
+
 # All opened files that are used when printing logs
 fileOpened = {}
 
+# Lines written to each of the log files, the key is the same as in fileOpened
+fileSeen = {}
+
+# Number of different lines kept in memory for each log file
+logSetSize = 1000000
+
+# Open database connections, the same connection is used for all the
+# configuration files and tables
+connections = {}
+
+# Private copies of databases SQLite would write to, the key is the original
+# path and the value is the path to the copy
+privateCopies = {}
+
+# Directory with the snapshot, databases there are already private copies
+snapshotDir = None
+
+# Tables and columns in the databases, so they are only read once
+schemaCache = {}
+
+# Results of direct queries, most recently used last. Same values are often
+# looked up many times, like the same sender or thread.
+queryCache = collections.OrderedDict()
+queryCacheSize = 10000
+queryCacheStats = {"hits" : 0, "misses" : 0}
+
+# Placeholders in direct queries. The value used to be pasted into the query,
+# so '?' and "?" were used to match text keys, they are bound as text. Other
+# strings are skipped, since a '?' in them is not a placeholder.
+placeholderRe = re.compile(r"'\?'|\"\?\"|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\?")
+
+# Direct queries with the quoted placeholders replaced, and for each
+# placeholder if it is bound as text, the key is the query in the configuration
+directQueries = {}
+
+# Resolve direct queries for many rows with one query
+batchDirect = False
+
+# Number of rows read from SQLite at a time, also the number of rows direct
+# queries are resolved for at a time
+chunkSize = 500
+
+# Direct queries on the form "SELECT ... FROM table WHERE key = ?" can be
+# rewritten to look up many values at once
+directBatchRe = re.compile(r"^\s*SELECT\s+(.+?)\s+FROM\s+([^()?]+?)\s+WHERE\s+" +\
+r"([\w.]+)\s*=\s*\?\s*;?\s*$", re.IGNORECASE | re.DOTALL)
+
+# Selects with aggregates or DISTINCT give a different result when they are run
+# for many keys at once, so they are not rewritten
+directAggregateRe = re.compile(r"\b(DISTINCT|OVER)\b|\b(COUNT|SUM|AVG|MIN|MAX|" +\
+r"TOTAL|GROUP_CONCAT)\s*\(", re.IGNORECASE)
+
+# Worker processes can't write to the log files, the lines are stored here and
+# written by the main process
+bufferLogFiles = False
+fileBuffered = {}
+
+# Directory with results from earlier runs, one entry for each database. Is
+# None unless the user asks for it.
+resultCache = None
+
+# Must be changed when the events created from a database change
+RESULTVERSION = 1
+
+# Values written to log files while one database is processed, so they can be
+# stored with the result
+logFileRecord = None
+
+# Number of threads used to calculate hash values of databases, and the number
+# of bytes read at a time
+hashThreads = 4
+hashBlock = 1024 * 1024
+
+# Files that are part of a database and must be copied with it to the snapshot
+snapshotEndings = ["-wal", "-journal"]
+
+# Different LogCat levels and their shorthand letters
+logcatLevels = {"V" : "Verbose", "D" : "Debug", "I" : "Information", "W" :\
+"Warning", "E" : "Error", "F" : "Fatal", "S" : "Silent"}
+
+# One line in a LogCat file, "01-10 00:00:00.000 D/Tag(  100): Message"
+logcatRe = re.compile(r"^(\d\d-\d\d) (\d\d:\d\d:\d\d)(\.\d+)?\s+([A-Z])/(.*?)\s*" +\
+r"\(\s*(\d+)\):\s?(.*)$")
+
+# Priorities in binary log buffers and the letters used in text logs
+logcatPriorities = {2 : "V", 3 : "D", 4 : "I", 5 : "W", 6 : "E", 7 : "F",
+8 : "S"}
+
+# Header of one entry in a binary log buffer: payload length, header size,
+# process ID, thread ID, seconds and nanoseconds. The header size is 0 in the
+# oldest format, newer formats have more fields after these.
+logEntryHeader = struct.Struct("<HHiiii")
+
+# Names of the tags in the binary events buffer, read from event-log-tags
+eventTags = {}
+
+# Finds the location of coordinates. Reading the geojson files takes time, so
+# it is only created when we find the first coordinates.
+reversegeo = None
+Base = os.path.join(os.path.join("src", "shapefile"), "sources")
+geoPrecision = 4	# Decimals in the coordinates we look up
+geoCache = None	# Database with locations from earlier runs
+
 # Print error message and exit
 def exitError(msg):
 	print "ERROR: Message: " + str(msg) + " Status: " + globalStatus
@@ -92,34 +224,192 @@ def exitError(msg):
 
 # Calculate SHA-1 hash value of a file
 def sha1OfFile(filepath):
+	h = hashlib.sha1()
+	with open(filepath, 'rb') as f:
+		while True:
+			block = f.read(hashBlock)
+			if len(block) == 0:
+				break
+			h.update(block)
+	return h.hexdigest()
+
+# Information about a file that changes when the file is written to
+def fileStat(filepath):
+	st = os.stat(filepath)
+	return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+# Hash value of a file and the information it was calculated from
+def hashEntry(filepath):
+	st = fileStat(filepath)
+	return {"sha1" : sha1OfFile(filepath), "stat" : st}
+
+# Calculate hash values of many files at the same time, returns a dictionary
+# with the path as key
+def hashFiles(paths):
+	if verbose:
+		print "Calculating hash value of " + str(len(paths)) + " databases"
+	pool = multiprocessing.pool.ThreadPool(hashThreads)
+	try:
+		entries = pool.map(hashEntry, paths)
+	finally:
+		pool.close()
+		pool.join()
+	return dict(zip(paths, entries))
+
+# Copy a file and calculate the hash value at the same time, so the file is
+# only read once
+def copyAndHash(src, dst):
+	h = hashlib.sha1()
+	with open(src, "rb") as fin:
+		with open(dst, "wb") as fout:
+			while True:
+				block = fin.read(hashBlock)
+				if len(block) == 0:
+					break
+				h.update(block)
+				fout.write(block)
+	shutil.copystat(src, dst)
+	return h.hexdigest()
+
+# Copy one database and the journal that belongs to it. Returns the hash
+# entries of the files that were copied, the entries also hold the path to
+# the copy.
+def snapshotEntry(job):
+	src, dst = job
+	ret = []
+	for ending in [""] + snapshotEndings:
+		if ending != "" and os.path.isfile(src + ending) == False:
+			continue
+		st = fileStat(src + ending)
+		ret.append((src + ending, {"sha1" : copyAndHash(src + ending, dst + ending),
+		"stat" : st, "copy" : dst + ending}))
+	return ret
+
+# Copy the databases to a directory with the same structure as pathData, and
+# calculate the hash values while copying. Returns a dictionary with the
+# original path as key.
+def snapshotFiles(paths, pathData, Dir):
+	if verbose:
+		print "Copying " + str(len(paths)) + " databases to " + Dir
+	jobs = []
+	for path in paths:
+		dst = os.path.join(Dir, os.path.relpath(path, pathData))
+		if not os.path.isdir(os.path.dirname(dst)):
+			os.makedirs(os.path.dirname(dst))
+		jobs.append((path, dst))
+
+	pool = multiprocessing.pool.ThreadPool(hashThreads)
+	try:
+		entries = pool.map(snapshotEntry, jobs)
+	finally:
+		pool.close()
+		pool.join()
+
+	hashes = {}
+	for e in entries:
+		for path, entry in e:
+			hashes[path] = entry
+	return hashes
+
+# Write the hash values in the same format as sha1sum
+def writeManifest(name, hashes):
+	try:
+		f = open(name, "w")
+	except IOError as e:
+		print "I/O error({0}): {1}".format(e.errno, e.strerror)
+		sys.exit(0)
+	for path in sorted(hashes.keys()):
+		f.write(hashes[path]["sha1"] + "  " + path + "\n")
+	f.close()
+
+# Get the hash value of a file. It is only calculated again if the file has
+# changed since the last time, otherwise the stored value is used.
+def getHash(filepath, hashes):
+	entry = hashes.get(filepath, None)
+	if entry != None and entry["stat"] == fileStat(filepath):
+		return entry["sha1"]
 	if verbose:
 		print "Calculating hash value of " + filepath
-	with open(filepath, 'rb') as f:
-		return hashlib.sha1(f.read()).hexdigest()
+	entry = hashEntry(filepath)
+	hashes[filepath] = entry
+	return entry["sha1"]
+
+# Lines that have been written to a log file, so that each line is only written
+# once. When there are too many lines to keep in memory, they are moved to a
+# temporary database next to the log file.
+class LineSet:
+	def __init__(self, path):
+		self.path = path
+		self.lines = set()
+		self.db = None
+
+	# Add a line, returns False if it has been added before
+	def add(self, line):
+		if self.db != None:
+			if isinstance(line, unicode):
+				line = line.encode("utf-8")
+			cur = self.db.execute("INSERT OR IGNORE INTO lines VALUES (?)",
+			(buffer(line),))
+			return cur.rowcount == 1
+		if line in self.lines:
+			return False
+		self.lines.add(line)
+		if len(self.lines) > logSetSize:
+			self.moveToDisk()
+		return True
 
-# Remove duplicates in log files and close them
-def cleanLogFiles(logPath):
-	for k in fileOpened.keys():
-		# Need to reopen the file so we can write to it
-		fileOpened[k].close()
+	def moveToDisk(self):
+		if verbose:
+			print "Moving lines written to " + self.path + " to disk"
+		fd, self.name = tempfile.mkstemp(prefix="." + os.path.basename(self.path)+\
+		"-", suffix=".db", dir=os.path.dirname(self.path))
+		os.close(fd)
+		self.db = sqlite.connect(self.name)
+		self.db.execute("PRAGMA journal_mode = OFF")
+		self.db.execute("PRAGMA synchronous = OFF")
+		self.db.execute("CREATE TABLE lines (line BLOB PRIMARY KEY)")
+		lines = self.lines
+		self.lines = None
+		for line in lines:
+			self.add(line)
+
+	def close(self):
+		if self.db != None:
+			self.db.close()
+			os.remove(self.name)
+			self.db = None
+
+# Open a log file that columns can write values to
+def openLogFile(name, logPath):
+	if bufferLogFiles:
+		fileBuffered.setdefault(name, [])
+	elif name not in fileOpened.keys():
 		try:
-			f = open(os.path.join(logPath, k), "r+")
+			fileOpened[name] = open(os.path.join(logPath, name), "w")
+			fileSeen[name] = LineSet(os.path.join(logPath, name))
 		except IOError as e:
 			print "I/O error({0}): {1}".format(e.errno, e.strerror)
-			continue
-		lines = f.readlines()
-
-		# Remove duplicates
-		lines = list(set(lines))
-
-		# Get back to the start
-		f.seek(0)
+			sys.exit(0)
+
+# Write one value to a log file opened with openLogFile
+def writeLogFile(name, value):
+	if logFileRecord != None:
+		logFileRecord.append((name, value))
+	if bufferLogFiles:
+		fileBuffered.setdefault(name, []).append(value)
+	else:
+		# Lines are only written the first time we see them
+		for line in value.splitlines(True):
+			if fileSeen[name].add(line):
+				fileOpened[name].write(line)
 
-		for l in lines:
-			f.write(l)
-		# Remove the old lines
-		f.truncate()
-		f.close()
+# Close the log files, they have no duplicates
+def closeLogFiles():
+	for k in fileOpened.keys():
+		fileOpened[k].close()
+		fileSeen[k].close()
+	fileOpened.clear()
+	fileSeen.clear()
 
 # Get a dictionary representing the JSON input, keys are defined in keyWrite
 def getJsonKeys(keys, keyWrite, Json):
@@ -130,13 +420,37 @@ def getJsonKeys(keys, keyWrite, Json):
 			ret[keyW] = Dict[key]
 	return ret
 
-def handleDefaultStoreVars(Dict, event):
-	if "longitude" in Dict.keys() and "latitude" in Dict.keys():
-		if "reversegeo" in globals():
-			geo = reversegeo.reverseGeocode(float(Dict["longitude"]), float(Dict["latitude"]))
-			bef = event.text
-			bef += "<br /><b>Location</b>" + geo
-			event.text = bef
+# Get a string that identifies the files locations are found from, it is
+# empty if we can't find locations
+def getGeoSource():
+	if "reverseGEO" not in globals():
+		return ""
+	return reverseGEO.getSource(Base, "countries.geojson")
+
+# Get the object that finds locations, it is created the first time
+def getReverseGeo():
+	global reversegeo
+	if reversegeo == None and "reverseGEO" in globals():
+		reversegeo = reverseGEO.geoFiles(Base, "countries.geojson")
+		reversegeo.setCache(geoPrecision, geoCache)
+	return reversegeo
+
+# Add the location to the events that stored coordinates. Events is a list of
+# (event, stored values), the coordinates of all the events are looked up
+# together.
+def handleDefaultStoreVars(events):
+	found = []
+	for event, Dict in events:
+		if "longitude" in Dict.keys() and "latitude" in Dict.keys():
+			found.append((event, float(Dict["longitude"]), float(Dict["latitude"])))
+	if len(found) == 0 or getReverseGeo() == None:
+		return
+	geos = reversegeo.reverseGeocodeMany([(longi, lat) for event, longi, lat in
+	found])
+	for (event, longi, lat), geo in zip(found, geos):
+		bef = event.text
+		bef += "<br /><b>Location</b>" + geo
+		event.text = bef
 
 
 # Read and interpret logs
@@ -145,47 +459,376 @@ def handleDefaultStoreVars(Dict, event):
 #  in main or
 #  11-22 17:16:51.136 I/power   (  168): *** set_screen_state 1
 #  in the rest
-def readLogcat(fname, timezone):
+# Returns a generator of tuples with (time, date, level, type, message, seconds
+# since UNIX epoch), the first value can be used to sort lines from different
+# files. f is the open file and start the bytes that have already been read.
+def readLogcat(fname, f, start, timezone):
 	if verbose:
 		print "Reading logs from " + fname
 
-	# Different levels and their shorthand letters
-	Levels = {"V" : "Verbose", "D" : "Debug", "I" : "Information", "W" :\
-	"Warning", "E" : "Error", "F" : "Fatal", "S" : "Silent"}
-	ret = []	# List of dictionaries to return
+	year = str(datetime.now().year)
+	offsetTZ = getTimezoneOffset(timezone)
+	lastSecond = None	# Many lines are written in the same second
+	for line in logcatLines(f, start):
+		m = logcatRe.match(line)
+		if m == None:
+			continue	# Like "--------- beginning of main"
+		date, clock, ms, level, Type, pid, msg = m.groups()
+		if ms == None:
+			ms = ""
+
+		second = date + " " + clock
+		if second != lastSecond:
+			lastSecond = second
+			t = time.strptime(year + "-" + date + "T" + clock, "%Y-%m-%dT%H:%M:%S")
+			dateS = time.strftime("%b %d %Y %H:%M:%S", t)
+			epoch = calendar.timegm(t) - offsetTZ
+
+		# lxml doesn't accept control characters or text that isn't ASCII in a
+		# str, only those characters are removed
+		yield (second + ms, dateS + ms + " " + timezone,
+		logcatLevels.get(level, level), removeInvalidChars(Type),
+		removeInvalidChars(msg.strip()), epoch)
+
+# Write the events from the LogCat files in Dir. When they are combined with
+# the events from the databases, the time is written the same way and the same
+# clock skew and date limits are used.
+def writeLogcat(f, Dir, timezone, combined=False, skew=0, startD=0, endD=0):
+	global eventTags
+	files = ["radio.log", "main.log", "events.log"]
+
+	# Names of the tags in the binary events buffer, found on the phone in
+	# /system/etc/event-log-tags
+	if os.path.isfile(os.path.join(Dir, "event-log-tags")):
+		eventTags = readEventTags(os.path.join(Dir, "event-log-tags"))
+
+	# The logs are read at the same time and merged by time, rotated files are
+	# read before the current one
+	readers = []
+	for fi in files:
+		fnames = findLogcatFiles(Dir, fi)
+		if len(fnames) == 0:
+			fnames = [os.path.join(Dir, fi)]	# Gives an error when read
+		readers.append(readLogcatThread(fnames, timezone))
+	try:
+		for e in heapq.merge(*readers):
+			if combined and (e[5] > endD or e[5] < (startD-1)):
+				continue
+			event = ET.Element("event")
+			event.set("title", e[4])
+			event.text = "Type: " + e[3] + "</br>" + "Level: " + e[2]
+			if combined:
+				event.set("start", time.strftime('%Y-%m-%dT%H:%M:%SZ',
+				time.gmtime(e[5]+skew)))
+			else:
+				event.set("start", e[1])
+			writeEvent(f, event)
+	except IOError as e:
+		print "I/O error({0}): {1}".format(e.errno, e.strerror)
+		sys.exit(0)
+
+# Read the names of the tags in the events buffer, the format is one tag on
+# each line, like "2722 battery_level (level|1|6),(voltage|1|1)"
+def readEventTags(fname):
+	tags = {}
 	with open(fname) as f:
-		lines = f.readlines()
-	year = datetime.now().year
-	for line in lines:
-		dateI = line.find(" ")
-		date = line[:dateI]	# The date without clock
-		line = line[dateI+1:]
-		clockI = line.find(" ")
-		clock = line[:clockI]	# The clock with milliseconds
-		line = line[clockI+1:]
-
-		tmp1 = line.find(" ")
-		tmp2 = line.find("(")
-		if tmp1 < tmp1:	real = tmp1
-		else:					real = tmp2
-
-		info = line[:real]	
-		info = info.split("/")
-		level = info[0]
-		Type = info[1]
-		msg = line[real+1:].strip()
-		
-		timeI = clock.find(".")
-		date = time.strptime(str(year)+"-"+date + "T" + clock[:timeI],\
-		"%Y-%m-%dT%H:%M:%S")
-		realDate = time.strftime("%b %d %Y %H:%M:%S", date)
-		realDate += clock[timeI:] + " " + timezone
-
-		if level in Levels:
-			level = Levels[level]
-		tmpDic = {"date" : realDate, "level" : level, "type" : Type, "msg" : msg}
-		ret.append(tmpDic)
-	return ret
+		for line in f:
+			fields = line.split()
+			if len(fields) >= 2 and fields[0].isdigit():
+				tags[int(fields[0])] = fields[1]
+	return tags
+
+# Get the offset of the timezone in seconds, the format is +XXXX or +XX:XX
+def getTimezoneOffset(timezone):
+	sign = -1 if timezone[0] == "-" else 1
+	digits = timezone[1:].replace(":", "")
+	minutes = int(digits[:2]) * 60
+	if len(digits) >= 4:
+		minutes += int(digits[2:4])
+	return sign * minutes * 60
+
+# Decode one value in the events buffer, returns the value as text and where
+# the next value starts
+def decodeEventValue(buf, offset):
+	Type = ord(buf[offset])
+	offset += 1
+	if Type == 0:	# Integer
+		return str(struct.unpack_from("<i", buf, offset)[0]), offset + 4
+	elif Type == 1:	# Long
+		return str(struct.unpack_from("<q", buf, offset)[0]), offset + 8
+	elif Type == 2:	# String
+		length = struct.unpack_from("<i", buf, offset)[0]
+		offset += 4
+		return buf[offset:offset+length], offset + length
+	elif Type == 3:	# List
+		count = ord(buf[offset])
+		offset += 1
+		values = []
+		for i in range(0, count):
+			value, offset = decodeEventValue(buf, offset)
+			values.append(value)
+		return "[" + ",".join(values) + "]", offset
+	elif Type == 4:	# Float
+		return repr(struct.unpack_from("<f", buf, offset)[0]), offset + 4
+	raise ValueError("Unknown type " + str(Type))
+
+# Decode the payload of one entry in the events buffer, a tag number followed
+# by one value. Returns level, type and message.
+def decodeEvent(buf, start, end):
+	tag = struct.unpack_from("<I", buf, start)[0]
+	try:
+		msg, offset = decodeEventValue(buf, start + 4)
+		if offset > end:
+			raise ValueError("Value is longer than the entry")
+	except (ValueError, struct.error, IndexError):
+		msg = "Unable to decode event"
+	return "I", eventTags.get(tag, str(tag)), msg
+
+# Decode the payload of one entry in the other buffers, priority followed by
+# tag and message, both ending with 0. Returns level, type and message.
+def decodeText(buf, start, end):
+	level = logcatPriorities.get(ord(buf[start]), "?")
+	tag, sep, msg = buf[start+1:end].partition("\0")
+	return level, tag, msg.rstrip("\0")
+
+# Read a binary log buffer, as written by "logcat -B" or copied from
+# /dev/log/*. The entries are decoded straight from the mapped file, or from
+# the decompressed contents if the file is compressed. Returns a
+# generator of the same tuples as readLogcat, but the time has nanoseconds.
+def readLogcatBinary(fname, f, start, timezone):
+	if verbose:
+		print "Reading binary logs from " + fname
+
+	# Compressed files can't be mapped, but buffers are small
+	if isCompressed(fname):
+		buf = start + f.read()
+	elif os.fstat(f.fileno()).st_size == 0:
+		return
+	else:
+		buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	# The events buffer has a different payload
+	events = os.path.basename(fname).startswith("events")
+	offsetTZ = getTimezoneOffset(timezone)
+	lastSecond = None
+	offset = 0
+	while offset + logEntryHeader.size <= len(buf):
+		length, hdrSize, pid, tid, sec, nsec =\
+		logEntryHeader.unpack_from(buf, offset)
+		if hdrSize == 0:
+			hdrSize = logEntryHeader.size
+		start = offset + hdrSize
+		end = start + length
+		# Not a log buffer or the last entry is cut off
+		if hdrSize < logEntryHeader.size or length == 0 or end > len(buf):
+			break
+		offset = end
+
+		if events:
+			level, Type, msg = decodeEvent(buf, start, end)
+		else:
+			level, Type, msg = decodeText(buf, start, end)
+
+		# Time in the buffer is UTC, but the text logs use the time of the phone
+		second = sec + offsetTZ
+		if second != lastSecond:
+			lastSecond = second
+			t = time.gmtime(second)
+			sortS = time.strftime("%m-%d %H:%M:%S", t)
+			dateS = time.strftime("%b %d %Y %H:%M:%S", t)
+
+		# The payload can hold anything, so only valid characters are kept
+		yield (sortS + ".%09d" % nsec, dateS + ".%03d" % (nsec // 1000000) +\
+		" " + timezone, logcatLevels.get(level, level), removeInvalid(Type),
+		removeInvalid(msg), sec)
+	if isCompressed(fname) == False:
+		buf.close()
+
+# Lines of an open LogCat file, start is the bytes that have already been read
+def logcatLines(f, start):
+	lines = (start + f.readline()).split("\n")
+	for line in lines[:-1]:
+		yield line + "\n"
+	if lines[-1] != "":
+		yield lines[-1]
+	for line in f:
+		yield line
+
+def isCompressed(fname):
+	return fname.endswith(".gz") or fname.endswith(".xz")
+
+# Open a LogCat file for reading, compressed files are decompressed while they
+# are read
+def openLogcat(fname):
+	if fname.endswith(".gz"):
+		return io.BufferedReader(gzip.open(fname, "rb"))
+	elif fname.endswith(".xz"):
+		if lzma != None:
+			return lzma.LZMAFile(fname, "rb")
+		if os.path.isfile(fname) == False:
+			raise IOError(2, "No such file or directory: " + fname)
+		return XzFile(fname)
+	return open(fname, "rb")
+
+# Output of "xz -dc" for a file, used when the lzma module is not installed.
+# When the file is closed we wait for xz, and raise IOError if it failed, so
+# that a broken file isn't silently cut off.
+class XzFile:
+	def __init__(self, fname):
+		self.fname = fname
+		try:
+			self.proc = subprocess.Popen(["xz", "-dc", fname], stdout=subprocess.PIPE)
+		except OSError as e:
+			raise IOError(e.errno, "Unable to run xz for " + fname)
+
+	def read(self, size=-1):
+		return self.proc.stdout.read(size)
+
+	def readline(self):
+		return self.proc.stdout.readline()
+
+	def __iter__(self):
+		return iter(self.proc.stdout)
+
+	# If check is False, we stopped reading because of an error, so xz is
+	# stopped instead of checked
+	def close(self, check=True):
+		if self.proc.stdout.closed:
+			return
+		if check:
+			while len(self.proc.stdout.read(hashBlock)) > 0:
+				pass
+		else:
+			self.proc.kill()
+		self.proc.stdout.close()
+		self.proc.wait()
+		if check and self.proc.returncode != 0:
+			raise IOError(5, "xz failed with exit status " +\
+			str(self.proc.returncode) + " for " + self.fname)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, Type, value, tb):
+		self.close(Type == None)
+
+# Find all the files for one log, oldest first. Logs are rotated to name.1,
+# name.2, etc, where the highest number is the oldest. Each file can be
+# compressed with gzip or xz, the uncompressed file is used if both exist.
+def findLogcatFiles(Dir, name):
+	reg = re.compile("^" + re.escape(name) + r"(?:\.([0-9]+))?(\.gz|\.xz)?$")
+	found = {}
+	for f in sorted(os.listdir(Dir)):
+		m = reg.match(f)
+		if m == None:
+			continue
+		num = 0 if m.group(1) == None else int(m.group(1))
+		if num not in found or m.group(2) == None:
+			found[num] = os.path.join(Dir, f)
+	return [found[num] for num in sorted(found.keys(), reverse=True)]
+
+# Check if a LogCat file is a binary log buffer from the first bytes of the
+# file, text logs start with a date or a line like "--------- beginning of main"
+def isBinaryLogcat(start):
+	if len(start) == 0:
+		return False
+	return re.match(r"(\d\d-\d\d |-+ )", start) == None
+
+# Read LogCat files in a separate thread and put the lines in the queue, a
+# chunk at a time. The files are read in the order they are given, and None
+# is put in the queue when we are done. If reading fails, the exception is put
+# in the queue before None, as the tuple from sys.exc_info().
+def readLogcatWorker(fnames, timezone, q):
+	try:
+		chunk = []
+		for fname in fnames:
+			# Each file is opened once, compressed files are only decompressed once
+			with openLogcat(fname) as f:
+				start = f.read(16)
+				if isBinaryLogcat(start):
+					lines = readLogcatBinary(fname, f, start, timezone)
+				else:
+					lines = readLogcat(fname, f, start, timezone)
+				for line in lines:
+					chunk.append(line)
+					if len(chunk) == chunkSize:
+						q.put(chunk)
+						chunk = []
+		q.put(chunk)
+	except BaseException:
+		q.put(sys.exc_info())
+	finally:
+		q.put(None)
+
+# Same as readLogcat, but the files are read one after the other in a separate
+# thread, so that several logs are read at the same time. Binary log buffers
+# and compressed files are also read. Exceptions in the thread are raised
+# here.
+def readLogcatThread(fnames, timezone):
+	q = Queue.Queue(16)
+	t = threading.Thread(target=readLogcatWorker, args=(fnames, timezone, q))
+	t.daemon = True
+	t.start()
+	while True:
+		chunk = q.get()
+		if chunk == None:
+			break
+		if isinstance(chunk, tuple):
+			raise chunk[0], chunk[1], chunk[2]
+		for line in chunk:
+			yield line
+
+# Check if SQLite would write to the files of a database when it is read or
+# closed, like when a journal is rolled back or the WAL is checkpointed
+def needsCopy(dbPath):
+	for ending in snapshotEndings:
+		if os.path.exists(dbPath + ending):
+			return True
+	try:
+		with open(dbPath, "rb") as f:
+			header = f.read(20)
+	except IOError:
+		return False
+	# Read and write version in the header are 2 if the database uses WAL
+	return header[18:20] == "\x02\x02"
+
+# Get a connection to a database that only reads from it, it is only opened
+# once. The library can't open a database read-only, so PRAGMA query_only
+# only stops our own queries from writing. Databases SQLite would write to
+# anyway are copied, together with the journal, to a private directory and
+# the copy is read instead. The copies are removed by closeDatabases.
+def openDatabase(dbPath):
+	if dbPath in connections:
+		return connections[dbPath]
+
+	readPath = dbPath
+	if dbPath in privateCopies:
+		readPath = privateCopies[dbPath]
+	elif (snapshotDir == None or not dbPath.startswith(snapshotDir + os.sep)) and\
+	needsCopy(dbPath):
+		Dir = tempfile.mkdtemp(prefix=".databases-", dir=tempDir)
+		readPath = os.path.join(Dir, os.path.basename(dbPath))
+		for ending in [""] + snapshotEndings:
+			if os.path.isfile(dbPath + ending):
+				shutil.copyfile(dbPath + ending, readPath + ending)
+		privateCopies[dbPath] = readPath
+
+	db = sqlite.connect(readPath)
+	try:
+		db.execute("PRAGMA query_only = ON")
+	except sqlite.Error:
+		pass
+	db.row_factory = dict_factory
+	connections[dbPath] = db
+	return db
+
+# Close all the databases opened with openDatabase and remove the copies
+def closeDatabases():
+	for dbPath in connections.keys():
+		connections[dbPath].close()
+	connections.clear()
+	for dbPath in privateCopies.keys():
+		shutil.rmtree(os.path.dirname(privateCopies.pop(dbPath)), True)
 
 # Return a dictionary instead of a tuple from sqlite3
 # Is only called from SQLite, not directly
@@ -357,31 +1000,28 @@ def findAndReplaceDouble(pathProgram, fullName, allNames, DB):
 	return allNames, DB
 
 # Read in configuration XML-file into a list of dictionaries
-# Will store any arbitrary attributes, interpreting them is not done here
+# Will store any arbitrary attributes, interpreting them is not done here. The
+# file itself is parsed by xmlConfig, which keeps a compiled version of it.
 def readXML(name, imageDesc, pathData, disallowOverride, logPath):
 	ret = []
 	try:
-		f = open(name, "r")
+		config = xmlConfig.getConfig(name)
 	except IOError as e:
 		print "I/O error({0}): {1}".format(e.errno, e.strerror)
 		sys.exit(0)
+	except ValueError as e:
+		exitError(str(e))
 	
 	# Find program directory
 	appName = os.path.basename(name)
 	nameEnd = appName.find(".xml")
 	appName = appName[:nameEnd]
-	
-	# Get root of our file
-	tree = ET.parse(f)
-	root = tree.getroot()
-
-	f.close()
 
 	# For each database
-	for dbT in root.iter("database"):
+	for database in config["databases"]:
 		DB = []	# List of duplicate databases
 		allNames = []	# All database names that are duplicates
-		fullName = dbT.get("id")	# Path to DB
+		fullName = database["id"]	# Path to DB
 		
 		# Check for regular expressions in DB path
 		fullName = findAndReplaceReg(fullName, pathData, appName)
@@ -389,108 +1029,176 @@ def readXML(name, imageDesc, pathData, disallowOverride, logPath):
 		# Check for duplicate databases
 		allNames, DB = findAndReplaceDouble(os.path.join(pathData, appName), fullName, allNames, DB)
 
-		tables = []	# All tables in this database
-		for elem in dbT.iter("table"):
-			table = {}
-			table["name"] = elem.get("id")
-
-			# Set status in case of error
-			globalStatus = "Reading XML file: " + name + " DB: " + fullName + " Table: " + table["name"]
-
-			columns = []	# All columns
-			inserts = []	# Static text inserted in attribute
-			queries = []	# Queries to replace foreign key
-			for el in elem.iterchildren():
-				if el.tag == "column":
-					column = {}
-
-					# Set some default values
-					column["name"] = el.text	# Column name in DB
-					column["print"] = el.text	# What we should say column is called
-					column["default"] = "None"	# When column is empty
-
-					# Various attributes that belong to the column. Some are
-					# interpreted here, if they are not mentioned here they are
-					# parsed when running the queries against the DB.
-					attrs = {}
-					for e in el.items():
-						# Use self-define header for column value
-						if e[0] == "override" and disallowOverride == False:
-							column["print"] = e[1]
-
-						# Specify default value to use when not found
-						elif e[0] == "default":
-							column["default"] = e[1]
-
-						# Several XML files can specify the same logfile, so we store
-						# them in a global dictionary and places the link the column
-						# attributes
-						elif e[0] == "logfile":
-							if e[1] not in fileOpened.keys():
-								try:
-									fileOpened[e[1]] = open(os.path.join(logPath, e[1]), "w")
-								except IOError as e:
-									print "I/O error({0}): {1}".format(e.errno, e.strerror)
-									sys.exit(0)
-							attrs["log"] = fileOpened[e[1]]
-
-						# Queries that has to be executes
-						elif e[0] == "query":
-							vals = e[1].split("|")
-							# "key" is default value, is meant to replace foreign key
-							if len(vals) <= 1 or vals[0] == "key":
-								if len(vals) == 1:
-									vals.insert(0, "key")
-								queries.append(vals[1])
-							elif len(vals) > 2:
-								exitError(str(e[1]) + " has too many dividers")
-							attrs["query"] = {"type" : vals[0], "query" : vals[1]}
-						# Add other stuff we don't need to parse here
-						else:
-							attrs[e[0]] = e[1]
-
-					column["attrs"] = attrs
-					columns.append(column)
-
-				# Can only be 1 icon tag
-				elif el.tag == "icon":
-					icon = {"file" : "../images/" + el.text, "description" :\
-					el.get("desc")}
-					table["icon"] = icon
-					imageDesc.append(icon)
-
-				# Can only be 1 where tag
-				elif el.tag == "where":
-					table["where"] = el.text
-
-				elif el.tag == "insert":
-					insert = {"name" : el.text, "id" : el.get("id")}
-					inserts.append(insert)
-
-				# Can only be one filter tag so we add it directly
-				elif el.tag == "filter":
-					table["filter"] = {}
-					tabID = el.get("columns", None)
-					if tabID != None:
-						cols = tabID.split(";")
-						table["filter"]["columns"] = cols
-					table["filter"]["static"] = el.get("static", "")
-					table["filter"]["stored"] = el.get("stored", "")
-			if "filter" in table:
-				for t in table["filter"].get("columns", []):
-					for c in columns:
-						if c["name"] == t:
-							c["attrs"]["filter"] = True
-			table["columns"] = columns
-			table["inserts"] = inserts
-			table["queries"] = queries
-			tables.append(table)
+		# The tables are changed when we run the queries, so the compiled version
+		# is copied
+		tables = copy.deepcopy(database["tables"])
+		for table in tables:
+			for column in table["columns"]:
+				# Use self-define header for column value
+				if "override" in column["attrs"] and disallowOverride == False:
+					column["print"] = column["attrs"]["override"]
+
+				# Several XML files can specify the same logfile
+				if "log" in column["attrs"]:
+					openLogFile(column["attrs"]["log"], logPath)
+
+			if "icon" in table:
+				imageDesc.append(table["icon"])
 
 		# Add all duplicate databases to return value
 		for name in allNames:
 			ret.append({"name" : name, "tables" : tables})
 	return ret
 
+# Functions that find the value to insert for a column, they are chosen when
+# the configuration is compiled
+
+# Type specifies values that should be replaced, usually integers that are
+# replaced by hardcoded strings. We also add the real value in parentheses.
+def valueType(c, value, event, localStorage, db, dbName):
+	name = c["plan"]["types"].get(str(value), None)
+	# Fallback if it's unknown, print the real value
+	if name == None:
+		return str(value)
+	return name + " (" + str(value) + ")"
+
+# Field is JSON
+def valueJson(c, value, event, localStorage, db, dbName):
+	ins, localStorage = getFileTypeJson(c, value, localStorage)
+	return ins
+
+# Field is path, print as usual, but also option to include media
+def valuePath(c, value, event, localStorage, db, dbName):
+	ins = str(value)
+	createMedia(ins, event)
+	return ins
+
+def valueUnsupported(c, value, event, localStorage, db, dbName):
+	exitError("Unsupported filetype '" + c["attrs"]["filetype"] + "'")
+
+# Replace value with result from query that is already executed
+def valueKey(c, value, event, localStorage, db, dbName):
+	if "queryResult" in c:
+		return getQueryCompleted(value, c)
+	return ""
+
+# We have to execute a new query
+def valueDirect(c, value, event, localStorage, db, dbName):
+	return getQueryNew(db, c, value, dbName)
+
+# We don't need to format or replace anything, we just need to encode the
+# variable correctly
+def valuePlain(c, value, event, localStorage, db, dbName):
+	if type(value) == int or type(value) == long or type(value) == float:
+		return str(value)
+	return value
+
+# Functions that place the value in the event, based on the id attribute. Only
+# timestamps return a value, the time in seconds.
+
+# Title is formatted i bit differently
+def outputTitle(plan, event, ins, skew):
+	event.set("title", "[" + plan["print"] + "] " + ins)
+
+# Description should not be placed as attribute but inside the tag
+def outputDescription(plan, event, ins, skew):
+	bef = event.text
+	if bef != "" and bef != None:	bef += "<br />"
+	else:	bef = ""
+	bef += plan["header"] + ins
+	event.text = bef
+
+# Timestamps must be formatted accordingly
+def outputTime(plan, event, ins, skew):
+	val = int( ( (long(ins)/plan["divide"]) - plan["subtract"]) )
+
+	# Get a time we can write in the event
+	event.set(plan["id"], time.strftime('%Y-%m-%dT%H:%M:%SZ',
+	time.gmtime(val+skew)))
+	return int(math.floor(val))
+
+# All other attributes that are not title, description, start or end
+def outputAttribute(plan, event, ins, skew):
+	event.set(plan["id"], plan["header"] + ins)
+
+# Must supply an ID attribute in XML file
+def outputMissing(plan, event, ins, skew):
+	exitError("No id attribute in " + plan["name"])
+
+# Interpret the attributes of one column once, the result is a plan that is
+# used for each row
+def compileColumn(c):
+	attrs = c["attrs"]
+	plan = {"name" : c["name"], "print" : c["print"],
+	"header" : "<b>" + c["print"] + "</b> ", "id" : attrs.get("id", None),
+	"start" : attrs.get("id", None) == "start", "store" : None,
+	"log" : attrs.get("log", None), "filter" : attrs.get("filter", False) == True,
+	"append" : attrs.get("append", None), "prepend" : attrs.get("prepend", None)}
+
+	# Same order as the attributes have always been checked in
+	if "type" in attrs:
+		plan["value"] = valueType
+		plan["types"] = {}
+		for ty in attrs["type"].split(";"):
+			ty = ty.split(":")
+			if len(ty) > 1:
+				# First mapping of a value is used
+				if ty[0] not in plan["types"]:
+					plan["types"][ty[0]] = ty[1]
+	elif "filetype" in attrs:
+		if attrs["filetype"] == "json" and "select" in attrs:
+			plan["value"] = valueJson
+			plan["jsonGet"], plan["jsonWrite"] = getJsonSelect(attrs["select"])
+		elif attrs["filetype"] == "path":
+			plan["value"] = valuePath
+		else:
+			plan["value"] = valueUnsupported
+	elif "query" in attrs:
+		if attrs["query"]["type"] == "direct":
+			plan["value"] = valueDirect
+			plan["batch"] = getBatchQuery(attrs["query"]["query"])
+		else:
+			plan["value"] = valueKey
+	else:
+		plan["value"] = valuePlain
+
+	# If we should store this column, this column can then be referenced by the
+	# XML file
+	if "store" in attrs and attrs["store"].lower() != "false":
+		plan["store"] = attrs["store"]
+		# Check if we should use default name or not
+		if plan["store"].lower() == "true":	plan["store"] = c["name"]
+
+	if plan["id"] == None:
+		plan["output"] = outputMissing
+	elif plan["id"] == "title":
+		plan["output"] = outputTitle
+	elif plan["id"] == "description":
+		plan["output"] = outputDescription
+	elif plan["id"] == "start" or plan["id"] == "end":
+		plan["output"] = outputTime
+		plan["divide"], plan["subtract"] = getTimeDivide(c)
+	else:
+		plan["output"] = outputAttribute
+	return plan
+
+# Compile all the tables returned from readXML, so that the configuration isn't
+# interpreted again for each row
+def compileXML(xmlO):
+	for x in xmlO:
+		for t in x["tables"]:
+			t["static"] = ""
+			t["stored"] = []
+			if "filter" in t:
+				t["static"] = t["filter"].get("static", "")
+				t["stored"] = t["filter"].get("stored", "").split(";")
+			for i in range(0, len(t["columns"])):
+				c = t["columns"][i]
+				c["plan"] = compileColumn(c)
+				# Position of the column in the rows from the query
+				c["plan"]["index"] = i
+	return xmlO
+
 # Retrieve the info from the database, runs a simple query and return the result
 def getInfoDB(db, columns, table, where=None, Log=None):
 	get = "SELECT "
@@ -503,15 +1211,32 @@ def getInfoDB(db, columns, table, where=None, Log=None):
 	get += " FROM " + table
 	if(where != None):
 		get += " WHERE " + where
-	return execQuery(db, get, Log)
+	return execQueryCursor(db, get, Log)
 
-# Executes any query against a given database
-def execQuery(db, query, Log=None):
+# Executes a query, but returns the cursor so that the rows can be read while
+# we go. Rows are tuples, not dictionaries.
+def execQueryCursor(db, query, Log=None):
 	retValue = True
-	ret = {}
+	cur = None
 	try:
 		cur = db.cursor()
+		cur.row_factory = None
 		cur.execute(query)
+		if Log != None:
+			Log.append(query)
+	except sqlite.Error, e:
+		print "WARNING:  %s: Query: " % e.args[0], query
+		retValue = False
+	return cur, retValue
+
+# Executes any query against a given database, params are bound to the '?' in
+# the query
+def execQuery(db, query, Log=None, params=()):
+	retValue = True
+	ret = {}
+	try:
+		cur = db.cursor()
+		cur.execute(query, params)
 		ret = cur.fetchall()
 		if Log != None:
 			Log.append(query)
@@ -578,9 +1303,14 @@ def createMedia(path, xml):
 	# The path for the web server
 	mediaPath = os.path.join(output, Type + "s")
 	
-	# Create directory if it doesn't exist
+	# Create directory if it doesn't exist, another process might create it at
+	# the same time
 	if not os.path.exists(mediaPath):
-		os.mkdir(mediaPath)
+		try:
+			os.mkdir(mediaPath)
+		except OSError:
+			if not os.path.isdir(mediaPath):
+				raise
 
 	# Full path to file
 	mediaPath = os.path.join(mediaPath, mediaName)
@@ -610,33 +1340,144 @@ def createMedia(path, xml):
 	return True
 
 # Find the value of a query we did earlier
-def getQueryCompleted(query, column):
-	ret = "Unknown"
-	for res in column.get("queryResult", {}).get("result", {}):
-		if query.get(column.get("name", ""), "invalid") == \
-		res.get(column["queryResult"].get("key", ""), "ivalid2"):
-			ret = removeInvalid(res.get(column["queryResult"].get("value", ""), "Unknown"))
-			break
-	return ret
+def getQueryCompleted(value, column):
+	key = normalizeKey(value)
+	index = column.get("queryResult", {}).get("index", {})
+	if key == None or key not in index:
+		return "Unknown"
+	return removeInvalid(index[key])
+
+# Keys from different tables might be stored with different types, like 5 and
+# "5", they are converted so that they are equal
+def normalizeKey(key):
+	if type(key) == int or type(key) == long:
+		return str(key)
+	if type(key) == float:
+		if key.is_integer():	return str(long(key))
+		return repr(key)
+	return key
+
+# Create a dictionary from key to value from the result of a "key" query, the
+# first row with a key is used
+def createQueryIndex(result, key, value):
+	index = {}
+	for res in result:
+		k = normalizeKey(res.get(key, None))
+		if k != None and k not in index:
+			index[k] = res.get(value, "Unknown")
+	return index
+
+
+# Store the result of a direct query, removes the least recently used result if
+# the cache is full
+def addQueryCache(key, res):
+	queryCache[key] = res
+	if len(queryCache) > queryCacheSize:
+		queryCache.popitem(last=False)
+
+# Split a direct query into the selected columns, the table and the key, so it
+# can be rewritten to use IN. Returns None if the query is not on that form.
+def getBatchQuery(run):
+	m = directBatchRe.match(run)
+	if m == None or directAggregateRe.search(m.group(1)) != None:
+		return None
+	return {"select" : m.group(1), "from" : m.group(2), "key" : m.group(3)}
+
+# Run the direct queries for a chunk of rows with one query per column and
+# place the results in the cache, getQueryNew will then find them there. Values
+# we don't find are left to getQueryNew, it will also report any errors.
+def resolveDirectBatch(db, dbName, columns, rows):
+	for c in columns:
+		run = c["attrs"]["query"]["query"]
+		batch = c["plan"]["batch"]
+
+		# Values that are not already in the cache, the same key might be stored
+		# with different types
+		values = {}
+		for q in rows:
+			v = q[c["plan"]["index"]]
+			if v == None or v == "" or type(v) == buffer:
+				continue
+			if (dbName, run, v) in queryCache:
+				continue
+			k = normalizeKey(v)
+			if k not in values:
+				values[k] = []
+			if v not in values[k]:
+				values[k].append(v)
+		if len(values) == 0:
+			continue
+
+		params = [vals[0] for vals in values.values()]
+		sql = "SELECT " + batch["key"] + " AS droidlog_key, " + batch["select"] +\
+		" FROM " + batch["from"] + " WHERE " + batch["key"] + " IN (" +\
+		",".join(["?"] * len(params)) + ")"
+		try:
+			cur = db.cursor()
+			cur.execute(sql, params)
+			names = [d[0] for d in cur.description][1:]
+			res = cur.fetchall()
+		except sqlite.Error, e:
+			if verbose:
+				print "WARNING:  %s: Query: " % e.args[0], sql
+			continue
 
+		found = {}
+		for r in res:
+			# Same columns, in the same order, as when the query is run on its own
+			row = {}
+			for name in names:	row[name] = r[name]
+			found.setdefault(normalizeKey(r["droidlog_key"]), []).append(row)
+		for k in found.keys():
+			for v in values.get(k, []):
+				addQueryCache((dbName, run, v), found[k])
+
+# Get a direct query with '?' and "?" replaced by ?, and a list that says if
+# each placeholder should be bound as text
+def getDirectQuery(run):
+	if run not in directQueries:
+		text = []
+		def replace(m):
+			if m.group(0) in ["?", "'?'", '"?"']:
+				text.append(m.group(0) != "?")
+				return "?"
+			return m.group(0)
+		directQueries[run] = (placeholderRe.sub(replace, run), text)
+	return directQueries[run]
 
 # Run a new query to replace the appropriate value
 def getQueryNew(db, column, insert, dbName):
 	# Get the base query
 	run = column["attrs"]["query"].get("query", "Missing column")
+	sql, text = getDirectQuery(run)
 
 	# Exit if there is nothing to replace
-	if run.find("?") == -1:
+	if len(text) == 0:
 		exitError("Invalid query :'" + run + "'")
 
-	# Replace the '?' with the user previous result
-	run = run.replace("?", insert)
-
-	# Execute the query
-	res, succ = execQuery(db, run)
-	if succ == False:
-		if db:	db.close()
-		exitError("Unable to connect to '" + str(dbName) + "'")
+	# Blobs can't be used as keys
+	key = (dbName, run, str(insert) if type(insert) == buffer else insert)
+	if key in queryCache:
+		queryCacheStats["hits"] += 1
+		# Move it to the end, so it's the last one to be removed
+		res = queryCache.pop(key)
+		queryCache[key] = res
+	else:
+		queryCacheStats["misses"] += 1
+
+		# Bind the previous result to all the '?', SQLite keeps the prepared
+		# statement
+		params = []
+		for t in text:
+			if t and not isinstance(insert, basestring):
+				params.append(str(insert))
+			else:
+				params.append(insert)
+		res, succ = execQuery(db, sql, None, tuple(params))
+		if succ == False:
+			if db:	db.close()
+			exitError("Unable to connect to '" + str(dbName) + "'")
+		addQueryCache(key, res)
 
 	# Use default value if we can't find a value
 	if len(res) == 0:		return column["default"]
@@ -649,11 +1490,10 @@ def getQueryNew(db, column, insert, dbName):
 			ret += "<i>" + k + "</i>: " + removeInvalid(r[k])
 	return ret
 
-# Convert JSON to a string based on the columns selected
-def getFileTypeJson(column, query, localStorage):
-	ret = "Error"
+# Get the JSON keys to select and the names to write them as
+def getJsonSelect(select):
 	# Get all different JSON keys that should be selected
-	Keys = column["attrs"]["select"].split(";")
+	Keys = select.split(";")
 
 	KeyGet = []		# The actual key
 	KeyWrite = []	# What we write
@@ -671,13 +1511,19 @@ def getFileTypeJson(column, query, localStorage):
 		# Append keys
 		KeyGet.append(tmp[0])
 		KeyWrite.append(tmp[1])
+	return KeyGet, KeyWrite
+
+# Convert JSON to a string based on the columns selected
+def getFileTypeJson(column, value, localStorage):
+	ret = "Error"
+	plan = column["plan"]
 
 	# Get a dictionary with our self-defined keys
-	Dict = getJsonKeys(KeyGet, KeyWrite, query[column["name"]])
+	Dict = getJsonKeys(plan["jsonGet"], plan["jsonWrite"], value)
 
 	for key in Dict:
 		ret += "<br /><i>" + str(key) + ": </i>" + str(Dict[key])
-		if "store" in column["attrs"] and column["attrs"]["store"].lower() != "false":
+		if plan["store"] != None:
 			localStorage[key] = str(Dict[key])
 	return ret, localStorage
 
@@ -689,6 +1535,8 @@ def runSetQueries(table, db, dbName, Queries):
 			if db:	db.close()
 			exitError("Could not connect to DB '" + dbName + "'")
 
+		indexes = {}	# Columns using the same query share the index
+
 		for c in table["columns"]:
 			if "query" in c["attrs"] and c["attrs"]["query"]["query"] == q\
 			and c["attrs"]["query"]["type"] == "key":
@@ -707,32 +1555,204 @@ def runSetQueries(table, db, dbName, Queries):
 				first = tmp.find(" ")
 				secondV = tmp[:first]
 
-				# Create 1 result that holds the entire result and which field
-				# is the key and which field is the value
-				c["queryResult"] = {"key" : firstV, "value" : secondV, "result" :
-				qq}
+				# Create 1 result that holds which field is the key and which field
+				# is the value, and an index to find the value from the key
+				if (firstV, secondV) not in indexes:
+					indexes[(firstV, secondV)] = createQueryIndex(qq, firstV, secondV)
+				c["queryResult"] = {"key" : firstV, "value" : secondV, "index" :
+				indexes[(firstV, secondV)]}
 	return table
 
+# Write one event to the output, indented the same way as lxml's pretty print
+def writeEvent(f, event):
+	f.write("  " + ET.tostring(event) + "\n")
+
+# Write the start of logs.xml, events are written one by one after this
+def writeTimelineStart(f, logCat):
+	f.write("<?xml version='1.0' encoding='ASCII'?>\n")
+	if logCat == True:
+		f.write("<data>\n")
+	else:
+		f.write("<data date-time-format=\"iso8601\">\n")
+
+def writeTimelineEnd(f):
+	f.write("</data>\n")
+
+# Events from one configuration file are written to a temporary file in
+# tempDir until we know that the configuration matches the databases.
+# This way memory use doesn't grow with the number of events.
+class EventSpool:
+	def __init__(self):
+		fd, self.name = tempfile.mkstemp(prefix=".events-", suffix=".xml",
+		dir=tempDir)
+		self.f = os.fdopen(fd, "wb")
+		self.count = 0
+
+	# Called by runQueries for each event that is accepted
+	def append(self, event):
+		writeEvent(self.f, event)
+		self.count += 1
+
+	# Add events from a file written earlier
+	def extend(self, name):
+		with open(name, "rb") as f:
+			shutil.copyfileobj(f, self.f)
+
+	def close(self):
+		self.f.close()
+
+	# Discard all the events
+	def remove(self):
+		self.close()
+		os.remove(self.name)
+
+# Copy events from a spool file to the output and remove the spool file
+def copySpool(f, name):
+	with open(name, "rb") as spool:
+		shutil.copyfileobj(spool, f)
+	os.remove(name)
+
+# Get the key of the stored result for one database. Everything that changes
+# the events created from the database must be part of the key.
+def getResultKey(settings, l, XMLconf, x, hashSum):
+	key = [RESULTVERSION, l, x["name"], hashSum, xmlConfig.getConfigHash(XMLconf),
+	settings["skew"], settings["timezone"], settings["startD"], settings["endD"],
+	settings["window"], settings["carve"], settings["disallow"],
+	settings["roots"], settings["symlinks"], geoPrecision, getGeoSource()]
+	return hashlib.sha1(repr(key)).hexdigest()
+
+# Get the stored result for one database, returns None if there is none
+def loadResult(key):
+	path = os.path.join(resultCache, key)
+	try:
+		with open(path + ".pickle", "rb") as f:
+			entry = pickle.load(f)
+	except Exception:
+		return None
+	if os.path.isfile(path + ".xml") == False:
+		return None
+	entry["events"] = path + ".xml"
+	return entry
+
+# Store the result for one database. The events are written before the rest,
+# so a result is never used before it is complete. Several processes might
+# store the same result at the same time.
+def saveResult(key, events, queries, logfiles):
+	path = os.path.join(resultCache, key)
+	tmp = "." + str(os.getpid())
+	try:
+		shutil.copyfile(events, path + ".xml" + tmp)
+		os.rename(path + ".xml" + tmp, path + ".xml")
+		with open(path + ".pickle" + tmp, "wb") as f:
+			pickle.dump({"queries" : queries, "logfiles" : logfiles}, f,
+			pickle.HIGHEST_PROTOCOL)
+		os.rename(path + ".pickle" + tmp, path + ".pickle")
+	except (IOError, OSError) as e:
+		print "Unable to store result for " + key + ": " + str(e)
+
+# Remove stored results that were not used in this run
+def pruneResults(used):
+	for name in os.listdir(resultCache):
+		if name.split(".")[0] not in used:
+			try:
+				os.remove(os.path.join(resultCache, name))
+			except OSError:
+				pass
+
+# Get the values a timestamp must be divided by and subtracted by to get
+# seconds since UNIX epoch
+def getTimeDivide(c):
+	# Default divide value (milliseconds, UNIX)
+	divide = 1000
+	subtract = 0
+
+	# Different epoch than UNIX
+	if "epoch" in c["attrs"]:
+		if c["attrs"]["epoch"].lower() == "windows":
+			divide = 10000000	# Standard in Windows
+			subtract = 11644473600
+		else:
+			exitError("Epoch '" + c["attrs"]["epoch"] + \
+			"' is not supported")
+
+	# Change the value we shoulde divide by
+	if "divide" in c["attrs"]:
+		# Divide can be float or integer
+		divide = c["attrs"]["divide"]
+		divide = float(divide) if '.' in divide else int(divide)
+	return divide, subtract
+
+# Create a predicate on the start column so that SQLite can skip rows outside
+# of the earliest and latest date. The limits are one second wider than what
+# we accept, the exact check is still done on each event. Returns None if there
+# is nothing to limit. schema holds the columns of the table, with their
+# declared type.
+def getDatePredicate(columns, earliest, latest, schema=None):
+	start = None
+	for c in columns:
+		if c["attrs"].get("id", "") == "start":
+			start = c
+	if start == None or (earliest == None and latest == None):
+		return None
+
+	# Text is always larger than numbers in SQLite, so time stamps stored as
+	# text are only compared correctly if they are converted first
+	name = start["name"]
+	if schema == None or isNumericType(schema.get(name.lower(), "")) == False:
+		name = "CAST(" + name + " AS REAL)"
+
+	divide, subtract = getTimeDivide(start)
+	preds = []
+	if earliest != None:
+		low = math.floor((long(earliest) - 2 + subtract) * divide)
+		preds.append(name + " >= " + str(long(low)))
+	if latest != None:
+		high = math.ceil((long(latest) + 1 + subtract) * divide)
+		preds.append(name + " <= " + str(long(high)))
+	return "(" + " AND ".join(preds) + ")"
+
+# Check if SQLite converts text to numbers in a column with this declared type,
+# the same rules SQLite uses to find the affinity of the column
+def isNumericType(declared):
+	declared = declared.upper()
+	if declared == "" or "BLOB" in declared:
+		return False
+	for text in ["CHAR", "CLOB", "TEXT"]:
+		if text in declared and "INT" not in declared:
+			return False
+	return True
+
 # Uses the configuration XML-file and the source database to create new XML-file
-# that is input to the timeline
+# that is input to the timeline. window holds earliest and latest date if they
+# have been specified by the user, None otherwise.
 def runQueries(dbName, xmlO, xml, skew, startD, endD, timezone, Queries,
-unallocated):
-	db = sqlite.connect(dbName)
-	db.row_factory = dict_factory
+unallocated, window=(None, None)):
+	db = openDatabase(dbName)
 	dateT = 0
 	for t in xmlO["tables"]:	# For all the tables
 		count = 0
+		hits = queryCacheStats["hits"]
+		misses = queryCacheStats["misses"]
 		if "where" not in t:
 			t["where"] = None
-		# Execute the actual query
-		query, succ = getInfoDB(db, t["columns"], t["name"], t["where"], Queries)
-		if unallocated != None:
-			for row in unallocated[t["name"]]:
-				query.append(row)
+
+		# Let SQLite filter out events outside of the date window
+		where = t["where"]
+		datePred = None
+		if window != (None, None):
+			schema = getSchema(dbName)
+			if schema != None:
+				schema = schema.get(t["name"].lower(), None)
+			datePred = getDatePredicate(t["columns"], window[0], window[1], schema)
+		if datePred != None:
+			if where == None:	where = datePred
+			else:	where = "(" + where + ") AND " + datePred
+
+		# Execute the actual query, the rows are read later
+		cur, succ = getInfoDB(db, t["columns"], t["name"], where, Queries)
 
 		# Return if we fail, might just be wrong XML file, so should not exit
 		if succ == False:
-			if db:	db.close()
 			print "\tDatabase: " + dbName
 			return False
 
@@ -740,194 +1760,141 @@ unallocated):
 		# them for every field value
 		t = runSetQueries(t, db, dbName, Queries)
 
-		# Defines 1 event
-		for q in query:
-			event = ET.Element("event")
-			localStorage = {}
-			
-			# Get static filter that should be used for this event
-			Filter = ""
-			if "filter" in t:	Filter = t["filter"].get("static", "")
-
-			# Get the icon that should be displayed, default is blue dot
-			if "icon" in t:
-				if "file" in t["icon"]:
-					event.set("icon", t["icon"]["file"])
-
-			# Insert attributes that have been specified
-			for i in t["inserts"]:	event.set(i["id"], i["name"])
-
-			# Go through all the columns and add attributes
+		# Direct queries that can be resolved for many rows at a time
+		batchColumns = []
+		if batchDirect:
 			for c in t["columns"]:
-				ins = ""	# The value that is inserted into the XML attribute
-
-				# q[c["name"]] holds the result for this columns and is not subject
-				# to change, which "ins" is.
-
-				# Set default value if we are unable find a real value
-				if q[c["name"]] == None or q[c["name"]] == "":
-					ins = c["default"]
-
-				# Type specifies values that should be replaced, usually integers
-				# that are replaced by hardcoded strings. We also add the real value
-				# in parentheses.
-				elif "type" in c["attrs"]:
-					types = c["attrs"]["type"].split(";")
-					for ty in types:
-						if ty != "" and str(ty.split(":")[0]) == str(q[c["name"]]):
-							ins = ty.split(":")[1] + " (" + str(q[c["name"]]) + ")"
-							break
-					# Fallback if it's unknown, print the real value
-					if ins == "":
-						ins = str(q[c["name"]])
-
-				# Column should not be interpreted as simple text
-				elif "filetype" in c["attrs"]:
-					Type = c["attrs"]["filetype"]
-
-					# Field is JSON
-					if Type == "json" and "select" in c["attrs"]:
-						ins, localStorage = getFileTypeJson(c, q, localStorage)
-
-					# Field is path, print as usual, but also option to include media
-					elif Type == "path":
-						ins = str(q[c["name"]])
-						createMedia(ins, event)
-
-					# Unsopported filetype
-					else:
-						exitError("Unsupported filetype '" + Type + "'")
-
-
-				# Replace value with result from different table
-				elif "query" in c["attrs"]:
-					# Query is already executed
-					if c["attrs"]["query"]["type"] == "key" and "queryResult" in c:
-						ins = getQueryCompleted(q, c)
-					
-					# We have to execute a new query
-					elif c["attrs"]["query"]["type"] == "direct":
-						ins = getQueryNew(db, c, str(q[c["name"]]), dbName)
-
-				# We don't need to format or replace anything, we just need to encode
-				# the variable correctly
-				elif type(q[c["name"]]) == int or type(q[c["name"]]) == long or type(q[c["name"]]) == float:
-					ins = str(q[c["name"]])
-				else:
-					ins = q[c["name"]]
-				
-				# Should always be encoded with valid html
-				ins = removeInvalid(ins).encode('ascii', 'xmlcharrefreplace')
-
-				# If we should store this column, this column can then be referenced
-				# by the XML file
-				if "store" in c["attrs"] and c["attrs"]["store"].lower() != "false":
-					key = c["attrs"]["store"]
-					
-					# Check if we should use default name or not
-					if key.lower() == "true":	key = c["name"]
-
-					localStorage[key] = q[c["name"]]
-				
-				# Write to log file if that is specified
-				if "log" in c["attrs"]:
-					c["attrs"]["log"].write(q[c["name"]] + "\n")
+				if c["plan"].get("batch", None) != None:	batchColumns.append(c)
 
-				# Add to filter if this column is specified with it
-				if c["attrs"].get("filter", False) == True:
-					Filter += removeInvalid(ins).encode('ascii', 'xmlcharrefreplace')
-				
-				# Static text is appended to the result
-				if "append" in c["attrs"]: 	ins += " " + c["attrs"]["append"]
-
-				# Static text is prepended to the result
-				if "prepend" in c["attrs"]:	ins = c["attrs"]["prepend"] + " " + ins
-
-				# id should always be included in the column tag
-				if "id" in c["attrs"]:
-					# Title is formatted i bit differently, so this is an exception
-					if c["attrs"]["id"] == "title":
-						event.set("title", "[" + c["print"] + "] " + ins)
-					else:
-						# Title for column is in bold
-						ins2 = "<b>" + c["print"] + "</b> "
-						
-						# Description should not be placed as attribute but inside the
-						# tag
-						if c["attrs"]["id"] == "description":
-							bef = event.text
-							if bef != "" and bef != None:	bef += "<br />"
-							else:	bef = ""
-							bef += ins2 + ins
-							event.text = bef
-						
-						else:
-							# Timestamps must be formatted accordingly
-							if c["attrs"]["id"] == "start" or c["attrs"]["id"] == "end":
-								# Default divide value (milliseconds, UNIX)
-								divide = 1000
-								subtract = 0
-
-								# Different epoch than UNIX
-								if "epoch" in c["attrs"]:
-									if c["attrs"]["epoch"].lower() == "windows":
-										divide = 10000000	# Standard in Windows
-										subtract = 11644473600
-									else:
-										exitError("Epoch '" + c["attrs"]["epoch"] + \
-										"' is not supported")
-
-								# Change the value we shoulde divide by
-								if "divide" in c["attrs"]:
-									# Divide can be float or integer
-									divide = c["attrs"]["divide"]
-									divide = float(divide) if '.' in divide else int(divide)
-
-								val = int( ( (long(ins)/divide) - subtract) )
-								
-								# If this is start, it should be used as a basis for
-								# filtering out too early or too late events
-								if c["attrs"]["id"] == "start":
-									dateT = int(math.floor(val))
-
-								# Get a time we can write in the event
-								ins = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(val+skew))
-
-								# Set time event
-								event.set(c["attrs"]["id"], ins)
-
-							# All other events that are not title, description, start
-							# or end
-							else:
-								event.set(c["attrs"]["id"], ins2 + ins)
-				else:
-					# Must supply an ID attribute in XML file
-					exitError("No id attribute in " + c["name"])
-
-			# Add locally stored variables
-			for fStored in t["filter"].get("stored", "").split(";"):
-				Filter += localStorage.get(fStored, "")
-
-			# Always set filter, might be empty
-			event.set("eventID", Filter)
+		tableUnallocated = None
+		if unallocated != None:
+			tableUnallocated = unallocated[t["name"]]
 
-			# Check if goes beyond our boundaries
-			if dateT <= endD and dateT >= (startD-1):
-				handleDefaultStoreVars(localStorage, event)
-				xml.append(event)
-				count += 1
+		try:
+			for rows in fetchRows(cur, t["columns"], tableUnallocated):
+				if len(batchColumns) > 0:
+					resolveDirectBatch(db, dbName, batchColumns, rows)
+
+				# Each row defines 1 event
+				events = []
+				for q in rows:
+					event, localStorage, dateT = createEvent(t, q, db, dbName, skew,
+					dateT)
+
+					# Check if goes beyond our boundaries
+					if dateT <= endD and dateT >= (startD-1):
+						events.append((event, localStorage))
+
+				# Locations are found for all the events in the chunk at once
+				handleDefaultStoreVars(events)
+				for event, localStorage in events:
+					xml.append(event)
+					count += 1
+		except sqlite.Error, e:
+			# Rows are read while we go, so the query can still fail
+			print "WARNING:  %s: Table: " % e.args[0], t["name"]
+			print "\tDatabase: " + dbName
+			return False
 
 		if verbose:
 			print "Selected " + str(count) + " records from database '" + dbName +\
 			"', table '" + str(t["name"]) + "'"
-	if db:
-		db.close()
+			hits = queryCacheStats["hits"] - hits
+			misses = queryCacheStats["misses"] - misses
+			if hits + misses > 0:
+				print "Direct query cache: " + str(hits) + " hits, " + str(misses) +\
+				" misses"
 	return True
 
+# Read the rows from the table query a chunk at a time, and then rows carved
+# from unallocated space. Rows are tuples in the same order as the columns.
+def fetchRows(cur, columns, unallocated=None):
+	while True:
+		rows = cur.fetchmany(chunkSize)
+		if len(rows) == 0:
+			break
+		yield rows
+
+	if unallocated != None:
+		rows = []
+		for r in unallocated:
+			rows.append(tuple([r[c["name"]] for c in columns]))
+		for i in range(0, len(rows), chunkSize):
+			yield rows[i:i+chunkSize]
+
+# Create one event from one row in a table, dateT is the last start time we
+# found. Returns the event, the values stored by the columns and the start time.
+def createEvent(t, q, db, dbName, skew, dateT):
+	event = ET.Element("event")
+	localStorage = {}
+	
+	# Get static filter that should be used for this event
+	Filter = t["static"]
+
+	# Get the icon that should be displayed, default is blue dot
+	if "icon" in t:
+		if "file" in t["icon"]:
+			event.set("icon", t["icon"]["file"])
+
+	# Insert attributes that have been specified
+	for i in t["inserts"]:	event.set(i["id"], i["name"])
+
+	# Go through all the columns and add attributes
+	for c in t["columns"]:
+		plan = c["plan"]
+
+		# value holds the result for this columns and is not subject to change,
+		# which "ins" is.
+		value = q[plan["index"]]
+
+		# Set default value if we are unable find a real value
+		if value == None or value == "":
+			ins = c["default"]
+		else:
+			ins = plan["value"](c, value, event, localStorage, db, dbName)
+		
+		# Should always be encoded with valid html
+		ins = removeInvalid(ins).encode('ascii', 'xmlcharrefreplace')
+
+		# Store the value so it can be referenced by the XML file
+		if plan["store"] != None:
+			localStorage[plan["store"]] = value
+		
+		# Write to log file if that is specified
+		if plan["log"] != None:
+			writeLogFile(plan["log"], value + "\n")
+
+		# Add to filter if this column is specified with it
+		if plan["filter"]:
+			Filter += removeInvalid(ins).encode('ascii', 'xmlcharrefreplace')
+		
+		# Static text is appended to the result
+		if plan["append"] != None: 	ins += " " + plan["append"]
+
+		# Static text is prepended to the result
+		if plan["prepend"] != None:	ins = plan["prepend"] + " " + ins
+
+		# If this is start, it should be used as a basis for filtering out too
+		# early or too late events
+		val = plan["output"](plan, event, ins, skew)
+		if plan["start"]:	dateT = val
+
+	# Add locally stored variables
+	for fStored in t["stored"]:
+		Filter += localStorage.get(fStored, "")
+
+	# Always set filter, might be empty
+	event.set("eventID", Filter)
+	return event, localStorage, dateT
+
 def removeInvalid(chunk):
 	if type(chunk) == int or type(chunk) == float or type(chunk) == long:
 		return str(chunk)
 	chunk = ' '.join(chunk .split())
+	return removeInvalidChars(chunk)
+
+# Same as removeInvalid, but the whitespace is left as it is
+def removeInvalidChars(chunk):
 	return ''.join([ch for ch in chunk if ord(ch) < 127 and ord(ch) > 31 or ord(ch) == 9 ])
 
 
@@ -984,6 +1951,256 @@ def getUnallocated(xmlConfig, dbPath):
 	# - Should also write unallocated log to a separate file
 	return sqlResult
 
+# Find all the databases the configuration files for the packages refer to
+def findDatabases(packs, settings):
+	paths = []
+	found = set()
+	for l in packs:
+		variants, missing = findVariants(settings["catalog"],
+		settings["pathConfig"], l)
+		for XMLconf in variants:
+			for x in readXML(XMLconf, [], settings["pathData"], settings["disallow"],
+			settings["logdir"]):
+				dbPath = os.path.join(settings["pathData"], l, x["name"])
+				if dbPath not in found and os.path.isfile(dbPath):
+					found.add(dbPath)
+					paths.append(dbPath)
+	return paths
+
+# Run the queries for one database and add the events to eventList. If key is
+# given, the result is also stored so it can be used in the next run.
+def runDatabase(dbPath, x, pathPackage, eventList, settings, Queries, key=None):
+	global logFileRecord
+	unallocated = None
+	if settings["carve"]:
+		unallocated = getUnallocated(x, pathPackage)
+	if key == None:
+		return runQueries(dbPath, x, eventList, settings["skew"],
+		settings["startD"], settings["endD"], settings["timezone"], Queries,
+		unallocated, settings["window"])
+
+	# Events, queries and log files are kept separate for this database
+	dbEvents = EventSpool()
+	start = len(Queries)
+	logFileRecord = []
+	ret = runQueries(dbPath, x, dbEvents, settings["skew"], settings["startD"],
+	settings["endD"], settings["timezone"], Queries, unallocated,
+	settings["window"])
+	logfiles = logFileRecord
+	logFileRecord = None
+	dbEvents.close()
+	if ret == True:
+		saveResult(key, dbEvents.name, Queries[start:], logfiles)
+		eventList.extend(dbEvents.name)
+	dbEvents.remove()
+	return ret
+
+# Find all the configuration files for a package, .xml, .xml.1, etc, in order,
+# from the catalog of the configuration directory. Returns the list of files
+# and the name of the first file that is missing.
+def findVariants(catalog, pathConfig, l):
+	ret = catalog.get(l, [])
+	return ret, xmlConfig.variantName(pathConfig, l, len(ret))
+
+# Get all the tables and their columns in a database, with the declared type of
+# each column. The names are in lower case. Returns None if the file can't be
+# read as a database.
+def getSchema(dbPath):
+	st = os.stat(dbPath)
+	key = (dbPath, st.st_size, st.st_mtime)
+	if key in schemaCache:
+		return schemaCache[key]
+
+	schema = {}
+	try:
+		cur = openDatabase(dbPath).cursor()
+		cur.execute("SELECT name FROM sqlite_master WHERE type='table' OR " +\
+		"type='view'")
+		for r in cur.fetchall():
+			table = r["name"]
+			cur.execute("PRAGMA table_info(\"" + table.replace('"', '""') + "\")")
+			schema[table.lower()] = dict([(c["name"].lower(), c["type"] or "") for c
+			in cur.fetchall()])
+	except sqlite.Error:
+		schema = None
+	schemaCache[key] = schema
+	return schema
+
+# Find how well a configuration matches the databases for a package. Returns
+# the fraction of tables and columns in the configuration that exist in the
+# databases we have. Databases we don't have are not counted.
+def matchVariant(xmlO, pathPackage):
+	found = 0
+	total = 0
+	for x in xmlO:
+		dbPath = os.path.join(pathPackage, x["name"])
+		if os.path.isfile(dbPath) == False:
+			continue
+		schema = getSchema(dbPath)
+		for t in x["tables"]:
+			total += 1 + len(t["columns"])
+			if schema == None or t["name"].lower() not in schema:
+				continue
+			found += 1
+			for c in t["columns"]:
+				if c["name"].lower() in schema[t["name"].lower()]:
+					found += 1
+	if total == 0:
+		return 0.0
+	return float(found) / total
+
+# Try the configuration files for one package, the one that best matches the
+# databases first, until one of them works. Returns a dictionary with the
+# events, image descriptions, log lines and queries, so that it can run in a
+# separate process
+def processPackage(l, settings):
+	res = {"package" : l, "log" : [], "events" : [], "images" : [],
+	"queries" : [], "success" : False, "config" : "", "results" : []}
+	pathData = settings["pathData"]
+	dbPath = ""
+	checked = {}	# Hash values of the databases that must be checked
+
+	# Databases are read from the snapshot if we have one, the original path is
+	# used in the logs
+	readPath = os.path.join(pathData, l)
+	if settings["snapshot"] != None:
+		readPath = os.path.join(settings["snapshot"], l)
+
+	# Read in all the configuration files
+	variants, missing = findVariants(settings["catalog"], settings["pathConfig"],
+	l)
+	configs = []
+	for XMLconf in variants:
+		tmpImageDescs = []
+		xmlO = readXML(XMLconf, tmpImageDescs, pathData, settings["disallow"],
+		settings["logdir"])	# Read xml configuration
+		configs.append({"name" : XMLconf, "xml" : compileXML(xmlO),
+		"images" : tmpImageDescs})
+
+	# Compare the configurations against the databases, instead of running all
+	# the queries to find out which one works. The order is kept when they
+	# match equally well.
+	if len(configs) > 1:
+		for conf in configs:
+			conf["match"] = matchVariant(conf["xml"], readPath)
+		configs.sort(key=lambda conf: -conf["match"])
+		if verbose:
+			print "Best matching configuration is " + configs[0]["name"] +\
+			" (" + str(int(configs[0]["match"] * 100)) + "% of tables and columns)"
+
+	for conf in configs:
+		ret = True
+		XMLconf = conf["name"]
+		res["config"] = XMLconf
+		res["log"].append("TRYING " + XMLconf + "\n")
+
+		xmlO = conf["xml"]
+		eventList = EventSpool()	# Temporary storage we append if we succeed
+		dbFinds = 0
+		for x in xmlO:	# For each database
+			tmpDir = os.path.join(pathData, l)
+			dbPath = os.path.join(tmpDir, x["name"])	# Full path
+			if os.path.isfile(dbPath) == False:
+				res["log"].append("MISSING " + dbPath + "\n")
+				continue
+			dbFinds += 1
+			if settings["hashcheck"] or resultCache != None:
+				hashSum = getHash(dbPath, settings["hashes"])
+			stored = None
+			key = None
+			if resultCache != None:
+				key = getResultKey(settings, l, XMLconf, x, hashSum)
+				res["results"].append(key)
+				stored = loadResult(key)
+			if stored != None:
+				# Nothing has changed since the last run
+				if verbose:
+					print "Using stored result for " + dbPath
+				eventList.extend(stored["events"])
+				for q in stored["queries"]:	res["queries"].append(q)
+				for name, value in stored["logfiles"]:	writeLogFile(name, value)
+				ret = True
+			else:
+				ret = runDatabase(os.path.join(readPath, x["name"]), x, readPath,
+				eventList, settings, res["queries"], key)
+			if settings["hashcheck"]:
+				checked[dbPath] = hashSum
+				res["log"].append("HASH " + hashSum + " " + dbPath + "\n")
+			if ret == False:
+				break
+		if ret == True and dbFinds > 0:
+			res["log"].append(None)	# Queries are written here
+			res["log"].append("SUCCESS " + XMLconf + " " + dbPath + "\n")
+			eventList.close()
+			res["events"] = eventList.name
+			res["images"] = conf["images"]
+			res["success"] = True
+			break
+		eventList.remove()
+
+	# None of the configuration files worked
+	if res["success"] == False:
+		res["config"] = missing
+		res["log"].append("MISSING " + missing + "\n")
+
+	# The databases of one package are not used by any other package
+	closeDatabases()
+
+	# The databases are checked after they are closed, since closing them could
+	# change them
+	for dbPath in sorted(checked.keys()):
+		hashSum2 = getHash(dbPath, settings["hashes"])
+		if checked[dbPath] != hashSum2:
+			print "Hash of sqlite database " + dbPath + \
+			" has changed from " + checked[dbPath] + " to " + hashSum2
+			sys.exit(0)
+
+	# Locations found are written after each package
+	if reversegeo != None:
+		reversegeo.flush()
+	return res
+
+# Set up global variables in a worker process, only needed when processing
+# packages in parallel
+def initWorker(settings):
+	global verbose, storagePaths, createSymlinks, output, bufferLogFiles
+	global batchDirect, resultCache, geoPrecision, geoCache, snapshotDir, tempDir
+	global droidlog, xmlConfig, SQLiteCarver, workerSettings
+	workerSettings = settings
+	verbose = settings["verbose"]
+	storagePaths = settings["roots"]
+	createSymlinks = settings["symlinks"]
+	output = settings["output"]
+	batchDirect = settings["batch"]
+	resultCache = settings["results"]
+	geoPrecision, geoCache = settings["geocache"]
+	snapshotDir = settings["snapshot"]
+	tempDir = settings["tempdir"]
+
+	# Log files are written by the main process
+	bufferLogFiles = True
+
+	sys.path.insert(0, os.path.join(settings["thisPath"], 'src/droidlog'))
+	import droidlog
+	import xmlConfig
+	if settings["carve"]:
+		sys.path.insert(0, os.path.join(settings["thisPath"], 'src/SQLiteCarving'))
+		import SQLiteCarver
+
+# Process one package in a worker process, the result must be sent back to the
+# main process
+def runPackageWorker(l):
+	try:
+		res = processPackage(l, workerSettings)
+	except SystemExit:
+		return {"exit" : True}
+
+	res["logfiles"] = {}
+	for name in fileBuffered.keys():
+		res["logfiles"][name] = fileBuffered[name]
+	fileBuffered.clear()
+	return res
+
 def checkAndCreateEnvironment(output, scriptPath):
 	global globalStatus
 	globalStatus = "checkAndCreateEnvironment(" + output + "," + scriptPath + ")"
@@ -1062,6 +2279,11 @@ if __name__== '__main__':
 	# Use LogCat logs instead of SQLite databases
 	parser.add_argument('-a', '--logcat', dest='logcat', action='store_true',
 	help="Use LogCat files instead of sqlite databases")
+
+	# Add LogCat files to the timeline from the databases
+	parser.add_argument('-A', '--add-logcat', dest='addlogcat', type=str,
+	default=None, metavar="DIR",
+	help="Add the LogCat files in DIR to the timeline from sqlite databases")
 	
 	# Add the possibility to check the hash of each file so we can be sure that
 	# SQLite doesn't change the file
@@ -1088,6 +2310,36 @@ if __name__== '__main__':
 	parser.add_argument('-r', '--root-paths', dest='roots', nargs='+', default=[],\
 	help='Root paths for various mount points')
 
+	# Resolve direct queries for many rows at a time
+	parser.add_argument('-b', '--batch-direct', dest='batch', action='store_true',
+	help="Resolve direct queries for many rows with one query")
+
+	# Store the result for each database and use it when the database and
+	# configuration file hasn't changed
+	parser.add_argument('-I', '--incremental', dest='incremental',
+	action='store_true', help="Reuse results from the last run for databases " +\
+	"and configuration files that haven't changed")
+
+	# Copy the databases before they are used
+	parser.add_argument('--snapshot', dest='snapshot', type=str, default=None,
+	help="Copy the databases to a directory in DIR and read them from there",
+	metavar="DIR")
+
+	# Coordinates that are this close are given the same location
+	parser.add_argument('--geocode-precision', dest='geoprecision', type=int,
+	default=4, metavar="N", help="Number of decimals coordinates are rounded " +\
+	"to before finding the location")
+
+	# Locations are stored between runs
+	parser.add_argument('--geocode-cache', dest='geocache', type=str,
+	default=None, metavar="FILE", help="Database where locations are stored " +\
+	"between runs, default is geocode.db next to the geojson files, an empty " +\
+	"string disables it")
+
+	# Number of processes used to process packages
+	parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+	help="Number of worker processes used to process packages")
+
 	# Get program directory
 	thisPath = os.path.dirname(os.path.realpath(__file__))
 
@@ -1114,10 +2366,19 @@ if __name__== '__main__':
 
 	sys.path.insert(0, os.path.join(thisPath, 'src/droidlog'))
 	import droidlog
+	import xmlConfig
 
 
 	verbose = args["verbose"]
 
+	# Locations are stored between runs, next to the geojson files by default
+	geoPrecision = args["geoprecision"]
+	geoCache = args["geocache"]
+	if geoCache == None and os.path.isdir(Base):
+		geoCache = os.path.join(Base, "geocode.db")
+	if geoCache == "":
+		geoCache = None
+
 	pathConfig = os.path.join(thisPath, args["config"])	# Path to configuration files
 
 	pathData = args["path"]	# Path to database files
@@ -1140,8 +2401,26 @@ if __name__== '__main__':
 
 	logCat = args["logcat"]
 
+	logcatPath = args["addlogcat"]
+	if logcatPath != None and os.path.isdir(logcatPath) == False:
+		print logcatPath + " is not a directory"
+		sys.exit(0)
+	if logcatPath != None and logCat:
+		print "-A can't be used with -a, -A adds LogCat files to the timeline " +\
+		"from the databases"
+		sys.exit(0)
+
 	hashcheck = args["hashcheck"]
 
+	jobs = args["jobs"]
+
+	snapshot = args["snapshot"]
+	if snapshot != None and os.path.isdir(snapshot) == False:
+		print snapshot + " is not a directory"
+		sys.exit(0)
+
+	batchDirect = args["batch"]
+
 	Queries = []
 
 	output = args["output"]
@@ -1152,6 +2431,16 @@ if __name__== '__main__':
 	# Create the necessary environment or exit if we fail
 	checkAndCreateEnvironment(output, thisPath)
 
+	# Worker processes use the same directory for temporary files, only this
+	# process removes it
+	tempDir = tempfile.mkdtemp(prefix=".tmp-", dir=output)
+	atexit.register(shutil.rmtree, tempDir, True)
+
+	# Results are stored in the output directory, between runs
+	if args["incremental"]:
+		resultCache = os.path.join(output, ".results")
+		if not os.path.isdir(resultCache):
+			os.mkdir(resultCache)
 
 	templates = os.path.join(thisPath, "templates")
 	shutil.copy2(os.path.join(templates, "index.html"),\
@@ -1174,6 +2463,10 @@ if __name__== '__main__':
 		endD = time.strptime(endD, "%Y-%m-%dT%H:%M")
 		endD = time.mktime(endD)
 
+	# Only the dates given by the user are used to limit the SQL queries
+	window = (startD if args["earliestdate"] != None else None,
+	endD if args["latestdate"] != None else None)
+
 	if os.path.isdir(pathConfig) == False:
 		print pathConfig + " is not a directory"
 		sys.exit(0)
@@ -1188,7 +2481,7 @@ if __name__== '__main__':
 		print "I/O error({0}): {1}".format(e.errno, e.strerror)
 		sys.exit(0)
 
-	root = ET.Element('data')	# Root element
+	writeTimelineStart(f, logCat)
 	
 	# Get all packages we should check, can gather this from the device:
 	# /data/system/packages.list
@@ -1199,85 +2492,101 @@ if __name__== '__main__':
 
 	imageDescs = []
 
+	resultsUsed = set()	# Stored results that are still valid
+
 	intervals = []
 
 	if logCat == True:
 		intervals = ["SECOND", "MINUTE", "HOUR", "DAY"]
-		files = ["radio.log", "main.log", "events.log"]
-		for fi in files:
-			evs = readLogcat(os.path.join(pathData, fi), timezone)
-			for e in evs:
-				event = ET.Element("event")
-				event.set("title", e["msg"])
-				event.text = "Type: " + e["type"] + "</br>" + "Level: " +\
-				e["level"]
-				event.set("start", e["date"])
-				root.append(event)
-
+		writeLogcat(f, pathData, timezone)
 
 	else:	# SQLite databases
-		root.set("date-time-format", "iso8601")
-		dbPath = ""
-		XMLconf = ""
-		unallocated = None
 		intervals = ["MINUTE", "HOUR", "DAY", "MONTH"]
-		for l in packs:
-			count = 0
-			while True:
-				ret = True
-				# Find the correct ending, .1, .2, etc
-				ending = "" if count == 0 else "." + str(count)
-				XMLconf = os.path.join(pathConfig, l) + ".xml" + ending
-
-				# Check if file exist
-				if os.path.isfile(XMLconf) == False:
-					log.write("MISSING " + XMLconf + "\n")
-					ret = False
-					break
-				else:
-					log.write("TRYING " + XMLconf + "\n")
-					
-				tmpImageDescs = []
-				xmlO = readXML(XMLconf, tmpImageDescs, pathData, disallow_override, logdir)	# Read xml configuration
-				eventList = []	# Temporary storage we append if we succeed
-				dbFinds = 0
-				for x in xmlO:	# For each database
-					tmpDir = os.path.join(pathData, l)
-					dbPath = os.path.join(tmpDir, x["name"])	# Full path
-					if os.path.isfile(dbPath) == False:
-						log.write("MISSING " + dbPath + "\n")
-						continue
-					dbFinds += 1
-					if hashcheck:
-						hashSum = sha1OfFile(dbPath)
-					if Carve:
-						tmpDir = os.path.join(pathData, l)
-						unallocated = getUnallocated(x, tmpDir)
-					ret = runQueries(dbPath, x, eventList, skew, startD, endD,
-					timezone, Queries, unallocated)
-					if hashcheck:
-						hashSum2 = sha1OfFile(dbPath)
-						if hashSum != hashSum2:
-							print "Hash of sqlite database " + dbPath + \
-							" has changed from " + hashSum + " to " + hashSum2
-							sys.exit(0)
-						log.write("HASH " + hashSum + " " + dbPath + "\n")
-					if ret == False:
-						break
-				if ret == True and dbFinds > 0:
+
+		# Everything a package needs to be processed on its own, also used to set
+		# up the worker processes
+		settings = {"pathConfig" : pathConfig, "pathData" : pathData,
+		"disallow" : disallow_override, "logdir" : logdir, "skew" : skew,
+		"startD" : startD, "endD" : endD, "window" : window,
+		"timezone" : timezone, "hashcheck" : hashcheck, "carve" : Carve,
+		"verbose" : verbose, "roots" : storagePaths, "symlinks" : createSymlinks,
+		"output" : output, "thisPath" : thisPath, "batch" : batchDirect,
+		"catalog" : xmlConfig.getCatalog(pathConfig), "results" : resultCache,
+		"hashes" : {}, "snapshot" : None, "tempdir" : tempDir,
+		"geocache" : (geoPrecision, geoCache)}
+
+		# Calculate the hash value of all the databases before we start, the
+		# values are checked again after each database has been used. With a
+		# snapshot, this is done while copying them.
+		if snapshot != None:
+			settings["snapshot"] = tempfile.mkdtemp(prefix="droidlog-",
+			dir=snapshot)
+			atexit.register(shutil.rmtree, settings["snapshot"], True)
+			settings["hashes"] = snapshotFiles(findDatabases(packs, settings),
+			pathData, settings["snapshot"])
+			snapshotDir = settings["snapshot"]
+		elif hashcheck or resultCache != None:
+			settings["hashes"] = hashFiles(findDatabases(packs, settings))
+		if snapshot != None or hashcheck or resultCache != None:
+			writeManifest(os.path.join(logdir, "manifest.sha1"), settings["hashes"])
+
+		pool = None
+		if jobs > 1:
+			if verbose:
+				print "Processing packages with " + str(jobs) + " worker processes"
+			pool = multiprocessing.Pool(jobs, initWorker, (settings,))
+			# imap keeps the order of the packages, so the result is the same as
+			# when running serially
+			results = pool.imap(runPackageWorker, packs)
+		else:
+			results = (processPackage(l, settings) for l in packs)
+
+		for res in results:
+			if res.get("exit", False) == True:
+				# Worker has already printed the reason
+				pool.terminate()
+				sys.exit(0)
+			if pool != None:
+				for name in res["logfiles"].keys():
+					openLogFile(name, logdir)
+					for line in res["logfiles"][name]:
+						writeLogFile(name, line)
+
+			# Queries from failed configurations are kept until the next one
+			# succeeds
+			for q in res["queries"]:	Queries.append(q)
+			for line in res["log"]:
+				# None marks where the queries should be written
+				if line == None:
 					for q in Queries:	log.write("QUERY " + q + "\n")
 					Queries = []
-					log.write("SUCCESS " + XMLconf + " " + dbPath + "\n")
-					for e in eventList:	root.append(e)
-					for i in tmpImageDescs:	imageDescs.append(i)
-					break
-				count += 1
-			if ret == False:	# After "while True" loop
-				if verbose == True:
-					print "Unable to extract logs using " + XMLconf
-
-	# Write full XML file to disk
-	f.write(str(ET.tostring(root, pretty_print=True, xml_declaration=True)))
+				else:
+					log.write(line)
+			for key in res["results"]:	resultsUsed.add(key)
+			if res["success"] == True:
+				copySpool(f, res["events"])
+				for i in res["images"]:	imageDescs.append(i)
+			elif verbose == True:
+				print "Unable to extract logs using " + res["config"]
+		if pool != None:
+			pool.close()
+			pool.join()
+
+		# LogCat events are added to the same timeline
+		if logcatPath != None:
+			writeLogcat(f, logcatPath, timezone, True, skew, startD, endD)
+
+		# The copies are only used in this run
+		if settings["snapshot"] != None:
+			shutil.rmtree(settings["snapshot"])
+
+		# Results from earlier runs that weren't used are not needed anymore
+		if resultCache != None:
+			pruneResults(resultsUsed)
+
+	# Events are already written, just close the root tag
+	writeTimelineEnd(f)
+	f.close()
 
 	# Print JavaScript variables that are used by the timeline
 	printVariables(os.path.join(output, "variables.js"), imageDescs, intervals,\
@@ -1286,8 +2595,11 @@ if __name__== '__main__':
 	# Go up one directory and print new file with links
 	printLinks(goUpDir(output))
 
-	# Clean up in the logs we wrote
-	cleanLogFiles(logdir)
+	# Close the logs we wrote
+	closeLogFiles()
+
+	if reversegeo != None:
+		reversegeo.close()
 
 	# Main log file
 	log.close()
@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Robin Stenvi
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Read the XML configuration files and keep a compiled version of them. The
+# compiled version is stored in ".compiled" in the same directory as the
+# configuration file and is used until the file changes.
+
+import os, re, hashlib
+import cPickle as pickle
+from lxml import etree as ET
+
+# Must be changed if the compiled structure changes
+VERSION = 1
+
+# Name of directory, under the configuration directory, with compiled files
+CACHEDIR = ".compiled"
+
+# SHA-1 of the configuration files we have read, the key is the path
+hashes = {}
+
+# Configuration files are called <package>.xml, other variants of the same
+# package are called <package>.xml.1, <package>.xml.2, etc
+variantRe = re.compile(r"^(.+)\.xml(?:\.([1-9][0-9]*))?$")
+
+# XML schemas we have read, the key is the path
+schemas = {}
+
+# Get the XML schema in the same directory as the configuration file, returns
+# None if there is no schema
+def getSchema(Dir):
+	path = os.path.join(Dir, "schema.xsd")
+	if path not in schemas:
+		schemas[path] = None
+		if os.path.isfile(path):
+			schemas[path] = ET.XMLSchema(ET.parse(path))
+	return schemas[path]
+
+# Read in one column tag. Attributes are stored as they are, except the ones
+# that are interpreted here.
+def readColumn(el, queries):
+	column = {}
+
+	# Set some default values
+	column["name"] = el.text	# Column name in DB
+	column["print"] = el.text	# What we should say column is called
+	column["default"] = "None"	# When column is empty
+
+	attrs = {}
+	for e in el.items():
+		# Specify default value to use when not found
+		if e[0] == "default":
+			column["default"] = e[1]
+
+		# Several XML files can specify the same logfile, the name is placed in
+		# the column attributes
+		elif e[0] == "logfile":
+			attrs["log"] = e[1]
+
+		# Queries that has to be executes
+		elif e[0] == "query":
+			vals = e[1].split("|")
+			# "key" is default value, is meant to replace foreign key
+			if len(vals) <= 1 or vals[0] == "key":
+				if len(vals) == 1:
+					vals.insert(0, "key")
+				queries.append(vals[1])
+			elif len(vals) > 2:
+				raise ValueError(str(e[1]) + " has too many dividers")
+			attrs["query"] = {"type" : vals[0], "query" : vals[1]}
+
+		# Add other stuff we don't need to parse here, including override which
+		# can be disallowed by the user
+		else:
+			attrs[e[0]] = e[1]
+
+	column["attrs"] = attrs
+	return column
+
+# Read in one table tag with all the columns
+def readTable(elem):
+	table = {}
+	table["name"] = elem.get("id")
+
+	columns = []	# All columns
+	inserts = []	# Static text inserted in attribute
+	queries = []	# Queries to replace foreign key
+	for el in elem.iterchildren():
+		if el.tag == "column":
+			columns.append(readColumn(el, queries))
+
+		# Can only be 1 icon tag
+		elif el.tag == "icon":
+			table["icon"] = {"file" : "../images/" + el.text, "description" :\
+			el.get("desc")}
+
+		# Can only be 1 where tag
+		elif el.tag == "where":
+			table["where"] = el.text
+
+		elif el.tag == "insert":
+			insert = {"name" : el.text, "id" : el.get("id")}
+			inserts.append(insert)
+
+		# Can only be one filter tag so we add it directly
+		elif el.tag == "filter":
+			table["filter"] = {}
+			tabID = el.get("columns", None)
+			if tabID != None:
+				cols = tabID.split(";")
+				table["filter"]["columns"] = cols
+			table["filter"]["static"] = el.get("static", "")
+			table["filter"]["stored"] = el.get("stored", "")
+	if "filter" in table:
+		for t in table["filter"].get("columns", []):
+			for c in columns:
+				if c["name"] == t:
+					c["attrs"]["filter"] = True
+	table["columns"] = columns
+	table["inserts"] = inserts
+	table["queries"] = queries
+	return table
+
+# Read in the information tag, returns None if it doesn't exist
+def readInformation(root):
+	info = root.find("information")
+	if info == None:
+		return None
+	ret = {}
+	for c in info.iterchildren("*"):
+		if c.tag == "description":
+			ret["description"] = c.text.replace("\n", " ").strip()
+		elif c.tag == "tested":
+			devices = []
+			for d in c.iterchildren("device"):
+				devices.append({"os" : d.get("os"), "device" : d.get("device")})
+			ret["tested"] = devices
+		elif c.tag == "short":
+			ret["short"] = c.text
+		elif c.tag == "extra":
+			tables = []
+			for t in c.iterchildren("table"):
+				tableE = {"id" : t.get("id"), "columns" : t.get("columns"),\
+				"reason" : t.get("reason")}
+				if tableE["columns"] != None:
+					tableE["columns"] = tableE["columns"].split(";")
+				else:
+					tableE["columns"] = []
+				tables.append(tableE)
+			ret["extra"] = tables
+	return ret
+
+# Parse and validate a configuration file. Database paths are not interpreted
+# here, since they depend on the directory we read from.
+def compileConfig(name, contents):
+	root = ET.fromstring(contents)
+
+	schema = getSchema(os.path.dirname(name))
+	if schema != None and schema.validate(root) == False:
+		print "WARNING: " + name + " does not match schema.xsd: " +\
+		str(schema.error_log.last_error)
+
+	databases = []
+	for dbT in root.iter("database"):
+		tables = []
+		for elem in dbT.iter("table"):
+			tables.append(readTable(elem))
+		databases.append({"id" : dbT.get("id"), "tables" : tables})
+	return {"databases" : databases, "info" : readInformation(root)}
+
+def cachePath(name):
+	return os.path.join(os.path.dirname(name), CACHEDIR,
+	os.path.basename(name) + ".pickle")
+
+# Read a compiled file, returns None if we can't
+def loadCache(path):
+	try:
+		with open(path, "rb") as f:
+			entry = pickle.load(f)
+	except Exception:
+		return None
+	if type(entry) != dict or entry.get("version", None) != VERSION:
+		return None
+	return entry
+
+# Write a compiled file, if the directory is read-only we just compile it again
+# next time
+def saveCache(path, entry):
+	tmp = path + "." + str(os.getpid())
+	try:
+		if not os.path.isdir(os.path.dirname(path)):
+			os.mkdir(os.path.dirname(path))
+		with open(tmp, "wb") as f:
+			pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+		# Several processes might write the same file
+		os.rename(tmp, path)
+	except (IOError, OSError):
+		if os.path.exists(tmp):
+			os.remove(tmp)
+
+# Get the compiled configuration file, it is only parsed if the file has
+# changed since it was compiled. Raises ValueError if the file can't be
+# interpreted and IOError if it can't be read.
+def getConfig(name):
+	st = os.stat(name)
+	path = cachePath(name)
+	entry = loadCache(path)
+	if entry != None and entry["mtime"] == st.st_mtime and\
+	entry["size"] == st.st_size:
+		hashes[name] = entry["sha1"]
+		return entry["config"]
+
+	with open(name, "rb") as f:
+		contents = f.read()
+	sha1 = hashlib.sha1(contents).hexdigest()
+	hashes[name] = sha1
+
+	# Only the time has changed, like after a checkout
+	if entry != None and entry["sha1"] == sha1:
+		entry["mtime"] = st.st_mtime
+		entry["size"] = st.st_size
+		saveCache(path, entry)
+		return entry["config"]
+
+	entry = {"version" : VERSION, "mtime" : st.st_mtime, "size" : st.st_size,
+	"sha1" : sha1, "config" : compileConfig(name, contents)}
+	saveCache(path, entry)
+	return entry["config"]
+
+# Get a hash that changes when the compiled configuration changes
+def getConfigHash(name):
+	if name not in hashes:
+		getConfig(name)
+	return str(VERSION) + ":" + hashes[name]
+
+# Get the file name of a variant, 0 is the first one
+def variantName(Dir, package, num):
+	ending = "" if num == 0 else "." + str(num)
+	return os.path.join(Dir, package) + ".xml" + ending
+
+# Read the configuration directory once, instead of checking if each variant
+# exists. Returns a dictionary with the package name as key and a list of the
+# variants in the order they should be tried. Like before, variants after a
+# missing number are not used.
+def getCatalog(Dir):
+	found = {}
+	for name in os.listdir(Dir):
+		m = variantRe.match(name)
+		if m == None:
+			continue
+		num = 0 if m.group(2) == None else int(m.group(2))
+		found.setdefault(m.group(1), set()).add(num)
+
+	catalog = {}
+	for package, nums in found.iteritems():
+		variants = []
+		while len(variants) in nums:
+			variants.append(variantName(Dir, package, len(variants)))
+		if len(variants) > 0:
+			catalog[package] = variants
+	return catalog
+
+if __name__ == "__main__":
+	print "Only import on this file"
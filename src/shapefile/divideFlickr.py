@@ -26,6 +26,7 @@
 # Divide the flickr geojson files into a structure more appropriate for us.
 
 import json, pprint, sys, os
+import geoPack
 
 # Converts a string to valid file name
 def getValidFileName(name):
@@ -247,4 +248,9 @@ if __name__ == "__main__":
 	print "Running checks to see if everything is correct\n"
 	sanityCheck("countries.geojson", "sources")
 
+	# Packed files are mapped into memory instead of parsed when we look up
+	# locations
+	print "Packing files for faster lookups\n"
+	print "Packed " + str(geoPack.packDir("sources")) + " files\n"
+
 	print "New files written under 'sources, you can now delete the downloaded files"
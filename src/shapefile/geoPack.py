@@ -0,0 +1,257 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Robin Stenvi
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Convert the geojson files from divideFlickr.py to a packed binary format that
+# can be mapped into memory instead of parsed. The format is:
+#  header:   magic, number of features, polygons, rings and points, size of
+#            the strings, name and type of the file
+#  points:   x and y of all the points as float64
+#  features: bounding box, first polygon, number of polygons and the strings
+#            type, place type, next file, label and geometry type
+#  polygons: first ring and number of rings, the first ring is the outer ring
+#            and the rest are holes
+#  rings:    first point and number of points
+#  strings:  all the strings, UTF-8 encoded
+# Strings are stored as offset and length, the length is NONE if the string
+# is None. Everything is little-endian.
+
+import json, os, sys, struct, mmap, array
+
+# Used for large polygons if it is installed, it is not necessary
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+MAGIC = "DLGEO\x00\x00\x01"
+HEADER = struct.Struct("<8sIIIIIIIII")
+HEADERSIZE = 48	# Points must be aligned
+FEATURE = struct.Struct("<4dIIIIIIIIIIII")
+PAIR = struct.Struct("<II")
+NONE = 0xFFFFFFFF
+
+# Polygons with at least this many points are checked with numpy
+NUMPYPOINTS = 64
+
+# Get the name of the packed version of a geojson file
+def packedName(File):
+	if File.endswith(".geojson"):
+		File = File[:-len(".geojson")]
+	return File + ".geobin"
+
+# Strings are added to one list and referred to with offset and length
+class StringTable:
+	def __init__(self):
+		self.strings = []
+		self.size = 0
+
+	def add(self, string):
+		if string == None:
+			return (0, NONE)
+		if isinstance(string, unicode):
+			string = string.encode("utf-8")
+		ret = (self.size, len(string))
+		self.strings.append(string)
+		self.size += len(string)
+		return ret
+
+# Convert one geojson file to the packed format
+def packFile(src, dst):
+	with open(src) as f:
+		Json = json.loads(f.read())
+
+	strings = StringTable()
+	points = array.array("d")
+	features = []
+	polygons = []
+	rings = []
+	for feature in Json.get("features", []):
+		properties = feature.get("properties", {})
+		geometry = feature.get("geometry", {})
+		gemType = geometry.get("type", "")
+		bbox = geometry.get("bbox", [-180.0, -90.0, 180.0, 90.0])
+
+		first = len(polygons)
+		if gemType != "MultiPolygon":
+			print gemType + " is not supported"
+		else:
+			for polygon in geometry.get("coordinates", []):
+				polygons.append((len(rings), len(polygon)))
+				for ring in polygon:
+					rings.append((len(points) / 2, len(ring)))
+					for point in ring:
+						points.append(point[0])
+						points.append(point[1])
+
+		ins = list(bbox) + [first, len(polygons) - first]
+		for string in [feature.get("type", ""), properties.get("place_type", ""),
+		properties.get("next", None), properties.get("label", ""), gemType]:
+			ins += strings.add(string)
+		features.append(ins)
+
+	name = strings.add(Json.get("name", ""))
+	Type = strings.add(Json.get("type", ""))
+
+	if sys.byteorder != "little":
+		points.byteswap()
+
+	tmp = dst + "." + str(os.getpid())
+	with open(tmp, "wb") as f:
+		f.write(HEADER.pack(MAGIC, len(features), len(polygons), len(rings),
+		len(points) / 2, strings.size, name[0], name[1], Type[0], Type[1]))
+		f.write("\x00" * (HEADERSIZE - HEADER.size))
+		points.tofile(f)
+		for feature in features:
+			f.write(FEATURE.pack(*feature))
+		for polygon in polygons:
+			f.write(PAIR.pack(*polygon))
+		for ring in rings:
+			f.write(PAIR.pack(*ring))
+		for string in strings.strings:
+			f.write(string)
+	os.rename(tmp, dst)
+
+# Convert all the geojson files in a directory
+def packDir(Dir):
+	count = 0
+	for File in sorted(os.listdir(Dir)):
+		if File.endswith(".geojson"):
+			packFile(os.path.join(Dir, File), packedName(os.path.join(Dir, File)))
+			count += 1
+	return count
+
+# determine if a point is inside a ring of points, the same way as
+# point_inside_polygon in reverseGEO. coords is a flat list of x and y values.
+def point_inside_flat(x, y, coords, n):
+	inside = False
+	p1x = coords[0]
+	p1y = coords[1]
+	for i in range(1, n+1):
+		j = (i % n) * 2
+		p2x = coords[j]
+		p2y = coords[j+1]
+		if y > min(p1y, p2y) and y <= max(p1y, p2y) and x <= max(p1x, p2x) and\
+		p1y != p2y:
+			xinters = (y-p1y)*(p2x-p1x)/(p2y-p1y)+p1x
+			if p1x == p2x or x <= xinters:
+				inside = not inside
+		p1x = p2x
+		p1y = p2y
+	return inside
+
+# Same as point_inside_flat, but all the edges are checked at once. xs and ys
+# are numpy arrays.
+def point_inside_numpy(x, y, xs, ys):
+	x2 = numpy.roll(xs, -1)
+	y2 = numpy.roll(ys, -1)
+	crosses = (y > numpy.minimum(ys, y2)) & (y <= numpy.maximum(ys, y2)) &\
+	(x <= numpy.maximum(xs, x2)) & (ys != y2)
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		xinters = (y-ys)*(x2-xs)/(y2-ys)+xs
+		crosses &= (xs == x2) | (x <= xinters)
+	return int(numpy.count_nonzero(crosses)) % 2 == 1
+
+# A ring of points in a mapped file, the points are only read when we check
+# if a point is inside
+class PackedRing:
+	def __init__(self, buf, offset, count):
+		self.buf = buf
+		self.offset = offset
+		self.count = count
+
+	# Get the x and y values as numpy arrays, they are views into the file
+	def arrays(self):
+		if self.count == 0:
+			return numpy.zeros(0), numpy.zeros(0)
+		points = numpy.frombuffer(self.buf, dtype="<f8", count=self.count*2,
+		offset=self.offset)
+		return points[0::2], points[1::2]
+
+	def contains(self, x, y):
+		if self.count == 0:
+			return False
+		if numpy != None and self.count >= NUMPYPOINTS:
+			# View into the mapped file, nothing is copied
+			xs, ys = self.arrays()
+			return point_inside_numpy(x, y, xs, ys)
+		coords = array.array("d", self.buf[self.offset:self.offset+self.count*16])
+		if sys.byteorder != "little":
+			coords.byteswap()
+		return point_inside_flat(x, y, coords, self.count)
+
+# Read a packed file, returns a dictionary in the same format as
+# reverseGEO.geoFiles.readFile, except that the rings are PackedRing objects.
+# Returns None if the file is not in the packed format.
+def readPacked(File):
+	with open(File, "rb") as f:
+		if os.fstat(f.fileno()).st_size < HEADERSIZE:
+			return None
+		buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	magic, nFeatures, nPolygons, nRings, nPoints, stringsSize, nameO, nameL,\
+	typeO, typeL = HEADER.unpack_from(buf, 0)
+	if magic != MAGIC:
+		return None
+
+	pointsO = HEADERSIZE
+	featuresO = pointsO + nPoints * 16
+	polygonsO = featuresO + nFeatures * FEATURE.size
+	ringsO = polygonsO + nPolygons * PAIR.size
+	stringsO = ringsO + nRings * PAIR.size
+
+	def getString(offset, length):
+		if length == NONE:
+			return None
+		return buf[stringsO+offset:stringsO+offset+length].decode("utf-8")
+
+	def getRing(i):
+		first, count = PAIR.unpack_from(buf, ringsO + i * PAIR.size)
+		return PackedRing(buf, pointsO + first * 16, count)
+
+	features = []
+	for i in range(0, nFeatures):
+		f = FEATURE.unpack_from(buf, featuresO + i * FEATURE.size)
+		polygons = []
+		for p in range(f[4], f[4] + f[5]):
+			firstRing, count = PAIR.unpack_from(buf, polygonsO + p * PAIR.size)
+			if count == 0:
+				continue
+			holes = [getRing(r) for r in range(firstRing + 1, firstRing + count)]
+			polygons.append({"polygon" : getRing(firstRing), "holes" : holes})
+		features.append({"type" : getString(f[6], f[7]),
+		"place_type" : getString(f[8], f[9]), "next" : getString(f[10], f[11]),
+		"name" : getString(f[12], f[13]), "geometry" : {"type" :
+		getString(f[14], f[15]), "bbox" : list(f[0:4]), "polygons" : polygons}})
+
+	return {"name" : getString(nameO, nameL), "type" : getString(typeO, typeL),
+	"features" : features}
+
+if __name__ == "__main__":
+	Dir = "sources"
+	if len(sys.argv) > 1:
+		Dir = sys.argv[1]
+	if os.path.isdir(Dir) == False:
+		print Dir + " is not a directory, run divideFlickr.py first"
+		sys.exit(0)
+	print "Packed " + str(packDir(Dir)) + " files in " + Dir
@@ -25,7 +25,15 @@
 
 # reverse geocoding based on longitude and latitude locations
 
-import json, pprint, os
+import json, pprint, os, math, collections, hashlib
+from pysqlite2 import dbapi2 as sqlite
+import geoPack
+
+# Used to look up many coordinates at once, it is not necessary
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 # determine if a point is inside a given polygon or not
 # Polygon is a list of (x,y) pairs.
@@ -48,6 +56,58 @@ def point_inside_polygon(x,y,poly):
 
     return inside
 
+# Same as point_inside_polygon for many points at once, xs and ys are numpy
+# arrays. Returns a numpy array of booleans.
+def points_inside_polygon(xs, ys, poly):
+	inside = numpy.zeros(len(xs), dtype=bool)
+	if isinstance(poly, geoPack.PackedRing):
+		px, py = poly.arrays()
+	else:
+		coords = numpy.array(poly, dtype=numpy.float64).reshape(-1, 2)
+		px, py = coords[:,0], coords[:,1]
+	if len(px) == 0:
+		return inside
+
+	# No edge can be crossed by points outside of these limits
+	sel = numpy.nonzero((ys > py.min()) & (ys <= py.max()) & (xs <= px.max()))[0]
+	p2x = numpy.roll(px, -1)
+	p2y = numpy.roll(py, -1)
+
+	# Points times edges should not be too large
+	step = max(1, (1 << 20) // len(px))
+	for i in range(0, len(sel), step):
+		idx = sel[i:i+step]
+		x = xs[idx][:,None]
+		y = ys[idx][:,None]
+		crosses = (y > numpy.minimum(py, p2y)) & (y <= numpy.maximum(py, p2y)) &\
+		(x <= numpy.maximum(px, p2x)) & (py != p2y)
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			xinters = (y-py)*(p2x-px)/(p2y-py)+px
+			crosses &= (px == p2x) | (x <= xinters)
+		inside[idx] = crosses.sum(axis=1) % 2 == 1
+	return inside
+
+# Strings from getSource, the files are only checked once
+sources = {}
+
+# Get a string that identifies the files we read locations from. Any of the
+# geojson and packed files in Base might be read, so it changes when any of
+# them changes. Returns an empty string if the first file doesn't exist.
+def getSource(Base, first):
+	if (Base, first) in sources:
+		return sources[(Base, first)]
+	ret = ""
+	if os.path.isfile(os.path.join(Base, first)) or\
+	os.path.isfile(os.path.join(Base, geoPack.packedName(first))):
+		h = hashlib.sha1()
+		for name in sorted(os.listdir(Base)):
+			if name.endswith(".geojson") or name.endswith(".geobin"):
+				st = os.stat(os.path.join(Base, name))
+				h.update(name + ":" + str(st.st_size) + ":" + str(st.st_mtime) + "\n")
+		ret = first + ":" + h.hexdigest()
+	sources[(Base, first)] = ret
+	return ret
+
 # Class to store the json files and check the name of a location.
 # If the json files are structured appropriately, it uses a hiararchical
 # structure. It can for example only read in one json file of continents, then
@@ -68,8 +128,32 @@ class geoFiles:
 
 		# List of previously found end feature, these are checked first to save
 		# time. Most locations are probably in the same area, so this should be
-		# faster in most cases. It is not sorted in any particular order.
+		# faster in most cases. The most recently found is last, and only
+		# previousSize features are kept.
 		self.previous = {"features" : []}
+		self.previousSize = 100
+
+		# Coordinates we are looking up together, see reverseGeocodeMany
+		self.batch = None
+
+		# Names we have found, the key is the rounded coordinates. Most recently
+		# used is last, only memoSize names are kept in memory.
+		self.memo = collections.OrderedDict()
+		self.memoSize = 10000
+
+		# Number of decimals the coordinates are rounded to, 4 is about 10 meters
+		self.precision = 4
+
+		# Database with names found in earlier runs, None if we don't use it
+		self.cacheFile = None
+		self.db = None
+		self.dbPid = None
+		# Names found since they were last written, they are written in one short
+		# transaction so other processes using the database don't have to wait
+		self.pending = []
+		self.pendingSize = 1000
+		# Identifies the files we read, names are only valid for the same files
+		self.source = getSource(Base, first)
 
 		# The order of how we choose, highest number is what we prefer.
 		self.order = {
@@ -83,6 +167,62 @@ class geoFiles:
 			"neighbourhood" : 5
 		}
 
+	# Set the precision of the coordinates and the database names are stored in
+	# between runs. The database can be shared by several cases, since the
+	# names only depend on the geojson files.
+	def setCache(self, precision, cacheFile):
+		self.precision = precision
+		self.memo.clear()
+		self.close()
+		self.cacheFile = cacheFile
+
+	# Get the database with stored names, it is opened again in a new process
+	def getDB(self):
+		if self.cacheFile == None:
+			return None
+		if self.db != None and self.dbPid == os.getpid():
+			return self.db
+		# Names found by the parent process are written by the parent
+		if self.dbPid != os.getpid():
+			self.pending = []
+		self.dbPid = os.getpid()
+		try:
+			self.db = sqlite.connect(self.cacheFile, timeout=30)
+			self.db.execute("CREATE TABLE IF NOT EXISTS places (source TEXT, " +\
+			"precision INTEGER, longitude REAL, latitude REAL, name TEXT, " +\
+			"PRIMARY KEY (source, precision, longitude, latitude))")
+		except sqlite.Error as e:
+			print "Unable to use " + self.cacheFile + " for locations: " + str(e)
+			self.cacheFile = None
+			self.db = None
+		return self.db
+
+	# Write the names we have found to the database. If the database is busy,
+	# the names are kept and written the next time.
+	def flush(self):
+		if len(self.pending) == 0 or self.db == None or\
+		self.dbPid != os.getpid():
+			return
+		try:
+			self.db.executemany("INSERT OR REPLACE INTO places VALUES " +\
+			"(?, ?, ?, ?, ?)", self.pending)
+			self.db.commit()
+			self.pending = []
+		except sqlite.Error as e:
+			self.db.rollback()
+			print "Unable to store " + str(len(self.pending)) + " locations in " +\
+			self.cacheFile + ": " + str(e)
+
+	def close(self):
+		self.flush()
+		if self.db != None and self.dbPid == os.getpid():
+			if len(self.pending) > 0:
+				print str(len(self.pending)) + " locations were not stored in " +\
+				self.cacheFile
+			self.db.close()
+		self.pending = []
+		self.db = None
+
 	# Get a list of polygons in a more suitable format
 	def getPolygons(self, coord, Type="MultiPolygon"):
 		if Type != "MultiPolygon":
@@ -114,9 +254,27 @@ class geoFiles:
 		return ret
 
 
+	# Get the packed version of a file if it exists and is not older than the
+	# geojson file, returns None otherwise
+	def readPacked(self, File):
+		packed = geoPack.packedName(File)
+		try:
+			st = os.stat(packed)
+			if os.path.isfile(File) and os.stat(File).st_mtime > st.st_mtime:
+				return None
+			return geoPack.readPacked(packed)
+		except (IOError, OSError):
+			return None
+
 	# Read in one file and return a dictionary with all the data we need
 	def readFile(self, File):
 		File = os.path.join(self.base, File)
+		insert = self.readPacked(File)
+		if insert != None:
+			insert["file"] = File
+			insert["index"] = self.buildIndex(insert["features"])
+			return insert
+
 		insert = {"file" : File}
 		contents = {}
 		try:
@@ -135,8 +293,57 @@ class geoFiles:
 			ins = self.getFeature(feature)
 			insert["features"].append(ins)
 
+		insert["index"] = self.buildIndex(insert["features"])
 		return insert
 
+	# Create a grid over the bounding boxes of the features, so we only have to
+	# check the features where the bounding box contains the point. Each cell
+	# holds a list of the features that overlap it, in the same order as in
+	# the file.
+	def buildIndex(self, features):
+		if len(features) == 0:
+			return None
+		bboxes = [f["geometry"]["bbox"] for f in features]
+		minX = min([b[0] for b in bboxes])
+		minY = min([b[1] for b in bboxes])
+		maxX = max([b[2] for b in bboxes])
+		maxY = max([b[3] for b in bboxes])
+
+		# About one feature in each cell if they were spread out evenly
+		n = int(math.ceil(math.sqrt(len(features))))
+		index = {"minX" : minX, "minY" : minY, "n" : n, "cells" : {},
+		"width" : max((maxX - minX) / n, 1e-9),
+		"height" : max((maxY - minY) / n, 1e-9)}
+
+		for f in features:
+			bbox = f["geometry"]["bbox"]
+			x1, y1 = self.getCell(index, bbox[0], bbox[1])
+			x2, y2 = self.getCell(index, bbox[2], bbox[3])
+			for x in range(x1, x2+1):
+				for y in range(y1, y2+1):
+					index["cells"].setdefault((x, y), []).append(f)
+		return index
+
+	# Get the cell in the grid a point is in
+	def getCell(self, index, x, y):
+		cellX = int((x - index["minX"]) / index["width"])
+		cellY = int((y - index["minY"]) / index["height"])
+		return min(max(cellX, 0), index["n"]-1), min(max(cellY, 0), index["n"]-1)
+
+	# Get the features the point might be in, based on the bounding boxes
+	def getCandidates(self, x, y, places):
+		index = places.get("index", None)
+		if index == None:
+			return places.get("features", [])
+		if x < index["minX"] or y < index["minY"]:
+			return []
+		ret = []
+		for f in index["cells"].get(self.getCell(index, x, y), []):
+			bbox = f["geometry"]["bbox"]
+			if bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]:
+				ret.append(f)
+		return ret
+
 	# Checks to see if we have already read in a file, returns None if it has not
 	# been read in
 	def findSecond(self, File, Array):
@@ -157,18 +364,59 @@ class geoFiles:
 			Array.append( place )
 		return place
 
-	# Find all places where the coordinates might fit in
+	# Rings from packed files are checked where they are mapped, rings from
+	# geojson files are lists of points
+	def insideRing(self, x, y, ring):
+		if isinstance(ring, geoPack.PackedRing):
+			return ring.contains(x, y)
+		return point_inside_polygon(x, y, ring)
+
+	# Check if a point is inside one of the polygons of a feature, but not in
+	# one of its holes
+	def insideFeature(self, x, y, feature):
+		if self.batch != None and (x, y) in self.batch["points"]:
+			return self.batchInside(feature)[self.batch["points"][(x, y)]]
+		for poly in feature.get("geometry", {}).get("polygons", []):
+			if self.insideRing(x, y, poly["polygon"]):
+				inHole = False
+				for hole in poly["holes"]:
+					if self.insideRing(x, y, hole):
+						inHole = True
+						break
+				if inHole == False:
+					return True
+		return False
+
+	# Check all the coordinates in the batch against a feature, the first time
+	# it is needed. Returns a numpy array of booleans.
+	def batchInside(self, feature):
+		batch = self.batch
+		if id(feature) not in batch["inside"]:
+			xs, ys = batch["xs"], batch["ys"]
+			inside = numpy.zeros(len(xs), dtype=bool)
+			for poly in feature.get("geometry", {}).get("polygons", []):
+				todo = numpy.nonzero(~inside)[0]
+				if len(todo) == 0:
+					break
+				found = points_inside_polygon(xs[todo], ys[todo], poly["polygon"])
+				for hole in poly["holes"]:
+					hit = numpy.nonzero(found)[0]
+					if len(hit) == 0:
+						break
+					found[hit] &= ~points_inside_polygon(xs[todo[hit]], ys[todo[hit]],
+					hole)
+				inside[todo] = found
+			# The feature is kept alive by the files we have read
+			batch["inside"][id(feature)] = inside
+		return batch["inside"][id(feature)]
+
+	# Find all places where the coordinates might fit in, only the places where
+	# the bounding box contains the point are checked
 	def findCoordinate(self, x, y, places):
 		rets = []
-		for a in places.get("features", []):
-			gem = a.get("geometry", {})
-			polygons = gem.get("polygons", [])
-			for poly in polygons:
-				if point_inside_polygon(x, y, poly["polygon"]):
-					if len(poly["holes"]) <= 0 or point_inside_polygon(x, y,\
-					poly["holes"]) == False:
-						rets.append(a)
-						break	# Break out of inner-loop
+		for a in self.getCandidates(x, y, places):
+			if self.insideFeature(x, y, a):
+				rets.append(a)
 		return rets
 
 	# Find the place that we should use, based on self.order
@@ -189,10 +437,80 @@ class geoFiles:
 		return places
 
 
-	# Do reverse geocoding on a set of coordinates to find the place. This
-	# function will read in extra files if necessary. The label in the last
-	# result is what is returned
+	# Do reverse geocoding on a set of coordinates to find the place. The
+	# coordinates are rounded, and the same coordinates are only looked up once.
+	# Returns the name of the place.
 	def reverseGeocode(self, longi, lat):
+		key = (round(longi, self.precision), round(lat, self.precision))
+		if key in self.memo:
+			name = self.memo.pop(key)
+			self.memo[key] = name
+			return name
+
+		name = None
+		db = self.getDB()
+		if db != None:
+			try:
+				row = db.execute("SELECT name FROM places WHERE source = ? AND " +\
+				"precision = ? AND longitude = ? AND latitude = ?", (self.source,
+				self.precision) + key).fetchone()
+				if row != None:
+					name = row[0]
+			except sqlite.Error:
+				pass
+
+		if name == None:
+			name = self.findPlace(key[0], key[1])
+			if db != None:
+				self.pending.append((self.source, self.precision) + key + (name,))
+				if len(self.pending) >= self.pendingSize:
+					self.flush()
+
+		self.memo[key] = name
+		if len(self.memo) > self.memoSize:
+			self.memo.popitem(last=False)
+		return name
+
+	# Same as reverseGeocode for a list of (longitude, latitude), returns a list
+	# of names. The places are found in the same order as with reverseGeocode,
+	# but with numpy each polygon is checked against all the new coordinates
+	# at the same time, the first time a coordinate is checked against it.
+	def reverseGeocodeMany(self, points):
+		if numpy != None:
+			keys = []
+			seen = set()
+			for longi, lat in points:
+				key = (round(longi, self.precision), round(lat, self.precision))
+				if key not in self.memo and key not in seen:
+					seen.add(key)
+					keys.append(key)
+			if len(keys) > 1:
+				self.batch = {"points" : dict(zip(keys, range(len(keys)))),
+				"xs" : numpy.array([k[0] for k in keys], dtype=numpy.float64),
+				"ys" : numpy.array([k[1] for k in keys], dtype=numpy.float64),
+				"inside" : {}}
+		try:
+			return [self.reverseGeocode(longi, lat) for longi, lat in points]
+		finally:
+			self.batch = None
+			self.flush()
+
+	# Remember a place we have found, so it is checked first the next time
+	def addPrevious(self, place):
+		if len(place) == 0:
+			return
+		features = self.previous["features"]
+		for i in range(0, len(features)):
+			if features[i] is place:
+				del features[i]
+				break
+		features.append(place)
+		if len(features) > self.previousSize:
+			del features[0]
+
+	# Find the place of a set of coordinates. This function will read in extra
+	# files if necessary. The label in the last result is what is returned
+	def findPlace(self, longi, lat):
 
 		# Look through previous first and see if we have seen that place before.
 		# It only looks at the final place, not the chain, which might be more
@@ -236,7 +554,7 @@ class geoFiles:
 			# Found no match or too many matches, we return the previous value we
 			# had
 			if result == None:
-				self.previous["features"].append(previous)
+				self.addPrevious(previous)
 				return previous.get("name", "Unknown")
 
 			# We have found one match, set this as the previous value and see if we
@@ -246,7 +564,7 @@ class geoFiles:
 
 		# Everything worked and we return the previous value, which is also the
 		# current value.
-		self.previous["features"].append(previous)
+		self.addPrevious(previous)
 		return previous.get("name", "Unknown")
 
 if __name__ == "__main__":